@@ -0,0 +1,173 @@
+# This file limits the uploads to the /data routes that are received at the same time, in total and per sensor,
+# by number and by bytes in flight (their Content-Length). An upload over a limit is rejected with
+# 429 Too Many Requests before its body is read, with a Retry-After computed from the observed upload throughput.
+# It runs as ASGI middleware because the multipart routes read the whole body before a dependency could reject them.
+# An upload only counts for a sensor once its access token is checked: sensor tokens count for the sensor they were
+# issued to, user and admin tokens for the sensor in the path. Uploads without a valid token share the budget of
+# ANONYMOUS, so they can't use up the budget of a sensor. The routes still reject them.
+# The limits apply per worker process, with several workers the server admits that many times more uploads.
+
+import math
+import random
+import re
+import time
+
+from starlette.responses import JSONResponse
+
+from app.server.database import retrieve_upload_session
+from app.server.routes.login import access_token_claims
+from app.server.models.data import UploadAdmissionSettings
+
+# (method, path) of the upload routes, the group "sensor" or "session" tells whose upload it is
+UPLOAD_ROUTES = [
+    ("PUT", re.compile(r"^/data/upload_session/(?P<session>[^/]+)/\d+(/raw)?$")),
+    ("POST", re.compile(r"^/data/upload/(?P<sensor>[^/]+)/[^/]+$")),
+    ("POST", re.compile(r"^/data/raw/(?P<sensor>[^/]+)/[^/]+$")),
+    ("POST", re.compile(r"^/data/(?!upload_session/)(?P<sensor>[^/]+)/[^/]+$")),
+]
+THROUGHPUT_WEIGHT = 0.2  # weight of the newest upload in the moving average of the throughput
+SESSION_CACHE_SIZE = 10000  # upload session id -> sensor name, cleared when it gets bigger
+ANONYMOUS = "(anonymous)"  # uploads without a valid access token, not a valid sensor name
+UPLOAD_PERMISSIONS = ["user", "admin", "sensor"]
+
+
+class UploadAdmission:
+    def __init__(self, settings: UploadAdmissionSettings):
+        self.settings = settings
+        self.uploads = 0
+        self.bytes_in_flight = 0
+        self.sensors = {}  # sensor name -> [uploads, bytes in flight]
+        self.throughput = None  # bytes per second of all uploads together, moving average
+        self.rejected = 0
+        self.session_sensors = {}
+
+    def check(self, sensor_name: str, size: int):
+        # returns None if the upload can start now, otherwise the seconds after which it should be tried again
+        settings = self.settings
+        sensor_uploads, sensor_bytes = self.sensors.get(sensor_name, (0, 0))
+        waits = []
+        if 0 < settings.max_concurrent_uploads <= self.uploads:
+            waits.append(self._drain_time(self.bytes_in_flight / self.uploads))
+        if 0 < settings.max_concurrent_uploads_per_sensor <= sensor_uploads:
+            waits.append(self._drain_time(sensor_bytes / sensor_uploads))
+        # an upload bigger than a byte limit is admitted when it is the only one, otherwise it would never be
+        if self.uploads and 0 < settings.max_upload_bytes_in_flight < self.bytes_in_flight + size:
+            waits.append(self._drain_time(self.bytes_in_flight + size - settings.max_upload_bytes_in_flight))
+        if sensor_uploads and 0 < settings.max_upload_bytes_in_flight_per_sensor < sensor_bytes + size:
+            waits.append(self._drain_time(sensor_bytes + size - settings.max_upload_bytes_in_flight_per_sensor))
+        if waits:
+            return max(waits)
+
+    def _drain_time(self, size: float) -> int:
+        # seconds until size bytes of the running uploads are received, spread a little so rejected sensors
+        # don't come back all at the same moment
+        seconds = size / self.throughput if self.throughput else self.settings.min_retry_after
+        seconds *= 1 + random.random() / 4
+        return min(max(math.ceil(seconds), self.settings.min_retry_after), self.settings.max_retry_after)
+
+    def acquire(self, sensor_name: str, size: int):
+        self.uploads += 1
+        self.bytes_in_flight += size
+        sensor = self.sensors.setdefault(sensor_name, [0, 0])
+        sensor[0] += 1
+        sensor[1] += size
+
+    def release(self, sensor_name: str, size: int, received: int, duration: float):
+        self.uploads -= 1
+        self.bytes_in_flight -= size
+        sensor = self.sensors[sensor_name]
+        sensor[0] -= 1
+        sensor[1] -= size
+        if sensor[0] == 0:
+            del self.sensors[sensor_name]
+        if received and duration > 0:
+            # the uploads share the bandwidth, so the throughput of all of them is this one's rate times their number
+            rate = received / duration * (self.uploads + 1)
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = THROUGHPUT_WEIGHT * rate + (1 - THROUGHPUT_WEIGHT) * self.throughput
+
+    def occupancy(self) -> dict:
+        return {
+            "uploads": self.uploads,
+            "bytes_in_flight": self.bytes_in_flight,
+            "throughput": round(self.throughput) if self.throughput else None,
+            "rejected": self.rejected,
+            "sensors": [{"sensor_name": sensor_name, "uploads": uploads, "bytes_in_flight": size}
+                        for sensor_name, (uploads, size) in self.sensors.items()],
+            "limits": self.settings.dict(),
+        }
+
+    async def upload_sensor(self, method: str, path: str, token: str = None) -> str:
+        # returns the name of the sensor that uploads with this request (ANONYMOUS without a valid access token),
+        # None if it is no upload
+        for route_method, pattern in UPLOAD_ROUTES:
+            match = pattern.match(path)
+            if method != route_method or not match:
+                continue
+            raw_jwt = await access_token_claims(token) if token else None
+            role = raw_jwt.get("role") if raw_jwt else None
+            if type(role) == list:
+                role = role[0]
+            if role not in UPLOAD_PERMISSIONS:
+                return ANONYMOUS
+            if role == "sensor":
+                return raw_jwt["sub"]
+            if "sensor" in pattern.groupindex:
+                return match.group("sensor")
+            session_id = match.group("session")
+            if session_id not in self.session_sensors:
+                try:
+                    session = await retrieve_upload_session(session_id)
+                except Exception:  # invalid id, the route answers with 404
+                    session = None
+                if len(self.session_sensors) > SESSION_CACHE_SIZE:
+                    self.session_sensors.clear()
+                self.session_sensors[session_id] = session["sensor_name"] if session else "unknown"
+            return self.session_sensors[session_id]
+
+
+upload_admission = UploadAdmission(UploadAdmissionSettings())
+
+
+class UploadAdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+        sensor_name = await upload_admission.upload_sensor(scope["method"], scope["path"],
+                                                           token if scheme.lower() == "bearer" else None)
+        if sensor_name is None:
+            return await self.app(scope, receive, send)
+
+        try:
+            size = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            size = 0
+        retry_after = upload_admission.check(sensor_name, size)
+        if retry_after is not None:
+            upload_admission.rejected += 1
+            response = JSONResponse({"detail": "Too many uploads, try again later."}, status_code=429,
+                                    headers={"Retry-After": str(retry_after)})
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        upload_admission.acquire(sensor_name, size)
+        start = time.monotonic()
+        try:
+            await self.app(scope, counting_receive, send)
+        finally:
+            upload_admission.release(sensor_name, size, received, time.monotonic() - start)
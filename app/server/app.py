@@ -1,17 +1,25 @@
+import asyncio
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.cors import CORSMiddleware
 
 # route for sensor data
-from app.server.routes.data import router as DataRouter
-from app.server.routes.sensors import router as SensorsRouter
-from app.server.routes.FixedJobs import router as FixedJobsRouter
+from app.server.routes.data import router as DataRouter, run_upload_session_reaper
+from app.server.routes.sensors import router as SensorsRouter, run_sensor_status_flusher, run_sensor_location_refresher
+from app.server.routes.FixedJobs import router as FixedJobsRouter, run_job_version_refresher, \
+    run_job_state_repairer
 from app.server.routes.login import router as LoginRouter
 from app.server.routes.userManagement import router as userMRouter
+from app.server.database import (ensure_indexes, flush_sensor_status, flush_sensor_status_history,
+                                 retrieve_sensor_locations_version, rebuild_sensor_locations,
+                                 count_unmigrated_assignments)
+from app.server.admission import UploadAdmissionMiddleware
 
 
 app = FastAPI()
 
+# limits the uploads that are received at the same time, added first so CORS headers are added to its rejections
+app.add_middleware(UploadAdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -20,6 +28,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+background_tasks = []  # keeps references to the tasks running next to the requests
+
+
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+    # the sensor locations are kept up to date by the status updates, they only have to be built once
+    if not await retrieve_sensor_locations_version():
+        await rebuild_sensor_locations()
+    unmigrated = await count_unmigrated_assignments()
+    if unmigrated:
+        print(f"startup: {unmigrated} fixed jobs and sensors still hold their assignments, "
+              f"run `python -m app.server.migrate_assignments`")
+    background_tasks.append(asyncio.create_task(run_upload_session_reaper()))
+    background_tasks.append(asyncio.create_task(run_sensor_status_flusher()))
+    background_tasks.append(asyncio.create_task(run_sensor_location_refresher()))
+    background_tasks.append(asyncio.create_task(run_job_version_refresher()))
+    background_tasks.append(asyncio.create_task(run_job_state_repairer()))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # the buffered sensor status updates must not get lost
+    try:
+        await flush_sensor_status()
+    except Exception as ex:
+        print(f"shutdown: sensor status not written: {ex}")
+    try:
+        await flush_sensor_status_history()
+    except Exception as ex:
+        print(f"shutdown: sensor status history not written: {ex}")
+
+
 app.include_router(DataRouter, tags=["Data"], prefix="/data")
 app.include_router(SensorsRouter, tags=["Sensors"], prefix="/sensors")
 app.include_router(FixedJobsRouter, tags=["Fixed Jobs"], prefix="/fixedjobs")
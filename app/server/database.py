@@ -6,13 +6,17 @@
 # e.g. findOne() becomes find_one() and MongoDB operators are encapsulated in quotation marks, plenty of examples below
 
 # Motor is an asynchronous Python driver for MongoDB
+import asyncio
 import motor.motor_asyncio
 import pymongo
+import pymongo.errors
 from bson.objectid import ObjectId
 import bcrypt
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from motor.motor_asyncio import AsyncIOMotorCollection
 
+from app.server.models.sensors import SensorStatusSettings
+
 # connection details
 MONGO_DETAILS = "mongodb://localhost:27017"
 
@@ -29,6 +33,20 @@ fixed_jobs_collection = database.get_collection("fixed_jobs")
 user_collection = database.get_collection("users")
 token_blacklist = database.get_collection("access_token_blacklist")
 token_whitelist = database.get_collection("refresh_token_whitelist")
+upload_sessions_collection = database.get_collection("upload_sessions")
+storage_usage_collection = database.get_collection("storage_usage")
+blobs_collection = database.get_collection("blobs")
+# time-series collection, created by ensure_indexes
+sensor_status_history_collection = database.get_collection("sensor_status_history")
+# map positions of the sensors, maintained by the status updates: _id = sensor name
+sensor_locations_collection = database.get_collection("sensor_locations")
+# version numbers of shared snapshots (e.g. the sensor locations): _id = name of the snapshot
+versions_collection = database.get_collection("versions")
+# versions of the pending job lists of the sensors: _id = sensor name
+job_versions_collection = database.get_collection("job_versions")
+# assignments of sensors to fixed jobs, one document per job and sensor with the state the sensor reported
+# ("state", None until it reports one) and whether the job is in the job list of the sensor ("listed")
+job_assignments_collection = database.get_collection("job_assignments")
 
 # sensor.status default-dict.
 sensor_default_status_dict = {
@@ -42,6 +60,34 @@ sensor_default_status_dict = {
     "Ethernet": "offline"
 }
 
+# status updates of the sensors that are not written to the db yet: sensor name -> status.
+# Heartbeats only update this dict, flush_sensor_status writes it with one bulk_write (last value wins).
+pending_sensor_status = {}
+# names of sensors that exist in the db, so a heartbeat doesn't need to look the sensor up
+known_sensor_names = set()
+sensor_status_settings = SensorStatusSettings()
+# set when so many status updates are buffered that they should be written before the flush interval is over
+sensor_status_flush_needed = asyncio.Event()
+# heartbeats that are not written to the status history yet, in the order they arrived
+pending_sensor_history = []
+
+# versions of the pending job lists, kept in memory by every worker so that polls of unchanged job lists don't
+# need the db, see JOB VERSION METHODS
+job_versions = {"sensors": {}, "all": 0, "loaded": False, "refreshed": None}
+# sensor name -> event that is set when the job list version of the sensor changes, used by the job streams
+job_version_events = {}
+
+# bands of the fleet summary: last contact in seconds before now and temperature in degrees celsius
+LAST_SEEN_BANDS = [300, 3600, 24 * 3600, 7 * 24 * 3600]
+TEMPERATURE_BANDS = [0, 20, 40, 60, 80]
+JOB_VERSION_REFRESH_OVERLAP = 10  # seconds
+# seconds a new reference waits between two looks at a blob whose file is being deleted, and after which such a
+# deletion counts as interrupted
+BLOB_DELETION_WAIT = 0.05
+BLOB_DELETION_TIMEOUT = 60
+# states a sensor can have within a fixed job, every job counts its sensors per state in "state_counts"
+FIXED_JOB_STATES = ["pending", "running", "finished", "failed"]
+
 user_default_dict = {
     "email": "",
     "username": "",
@@ -63,22 +109,194 @@ def data_helper(data) -> dict:
         "size": data["size"],
         "sensor_name": data["sensor_name"],
         "job_name": data["job_name"],
+        "content_hash": data.get("content_hash"),  # sha256 of the file, missing for uploads before it was stored
+        "blob": data.get("blob", False),  # stored content-addressed (by content_hash) instead of as <file_name>_<id>
+        "codec": data.get("codec"),  # compression of the stored file, None if it is stored as sent
+    }
+
+
+# fields of data_helper that can be selected with a projection, id is always included
+data_fields = ["file_name", "size", "sensor_name", "job_name", "content_hash", "blob", "codec"]
+
+
+# data_helper for a document that was queried with only some fields, returns only these fields and the id
+def data_projection_helper(data, fields: list) -> dict:
+    complete = data_helper({**dict.fromkeys(["file_name", "size", "file", "sensor_name", "job_name"]), **data})
+    return {key: complete[key] for key in ["id"] + fields}
+
+
+def blob_helper(blob) -> dict:
+    return {
+        "content_hash": blob["_id"],
+        "size": blob["size"],
+        "refcount": blob["refcount"],
+        "codec": blob.get("codec"),
+    }
+
+
+def upload_session_helper(session) -> dict:
+    received = set(session["received"])
+    return {
+        "id": str(session["_id"]),
+        "sensor_name": session["sensor_name"],
+        "job_id": session["job_id"],
+        "file_name": session["file_name"],
+        "chunk_count": session["chunk_count"],
+        "received_chunks": len(received),
+        "missing_chunks": [] if session["state"] == "complete" else
+                          [nr for nr in range(session["chunk_count"]) if nr not in received],
+        "received_bytes": session.get("bytes", 0),
+        "state": session["state"],
+        "data_id": session.get("data_id"),
+    }
+
+
+def storage_usage_helper(usage) -> dict:
+    return {
+        "sensor_name": usage["_id"],
+        "temp_bytes": usage.get("temp_bytes", 0),
+        "stored_bytes": usage.get("stored_bytes", 0),
+    }
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# One heartbeat in the status history. The schema is kept small, there is one document per heartbeat:
+# numbers instead of strings and 1/0 for online/offline, so the average of an interface is its online share.
+def sensor_history_entry(name: str, status: dict) -> dict:
+    if status["status_time"]:
+        time = datetime.fromtimestamp(int(status["status_time"]), timezone.utc)
+    else:
+        time = datetime.now(timezone.utc)
+    return {
+        "time": time,
+        "sensor_name": name,
+        "temperature": to_float(status["temperature_celsius"]),
+        "lat": to_float(status["location_lat"]),
+        "lon": to_float(status["location_lon"]),
+        "LTE": 1 if status["LTE"] == "online" else 0,
+        "WiFi": 1 if status["WiFi"] == "online" else 0,
+        "Ethernet": 1 if status["Ethernet"] == "online" else 0,
+    }
+
+
+def status_history_bucket_helper(bucket) -> dict:
+    return {
+        "time": int(bucket["_id"].replace(tzinfo=timezone.utc).timestamp()),
+        "heartbeats": bucket["heartbeats"],
+        "sensors": len(bucket["sensors"]),
+        "temperature_min": bucket["temperature_min"],
+        "temperature_avg": bucket["temperature_avg"],
+        "temperature_max": bucket["temperature_max"],
+        "LTE_online": bucket["LTE_online"],
+        "WiFi_online": bucket["WiFi_online"],
+        "Ethernet_online": bucket["Ethernet_online"],
+        "lat_avg": bucket["lat_avg"],
+        "lon_avg": bucket["lon_avg"],
+    }
+
+
+# Map position of a sensor. The position is rounded to 2 decimal places (about 1 km), the map must not show the
+# exact location. "location" is the position as GeoJSON point for the geo index, None if the sensor sent none.
+# A sensor is online if its last contact ("status_time") was less than sensor_offline_after ago.
+def sensor_location_entry(status: dict) -> dict:
+    lat = to_float(status["location_lat"])
+    lon = to_float(status["location_lon"])
+    if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        lat, lon = None, None
+    else:
+        lat, lon = round(lat, 2), round(lon, 2)
+    status_time = int(status["status_time"] or 0)
+    return {
+        "lat": lat,
+        "lon": lon,
+        "location": {"type": "Point", "coordinates": [lon, lat]} if lat is not None else None,
+        "status_time": status_time,
+        "online": status_time > datetime.now(timezone.utc).timestamp() - sensor_status_settings.sensor_offline_after,
     }
 
 
-def sensor_helper(sensor) -> dict:
+def location_cluster_helper(cluster) -> dict:
+    return {
+        "lat": round(cluster["lat"], 4),
+        "lon": round(cluster["lon"], 4),
+        "count": cluster["count"],
+        "online": cluster["online"],
+        "offline": cluster["count"] - cluster["online"],
+    }
+
+
+# Turns the result of the fleet summary aggregation into counts with readable keys, see retrieve_sensor_summary
+def sensor_summary_helper(facets, now: int) -> dict:
+    def counts(groups) -> dict:
+        return {str(group["_id"]) if group["_id"] is not None else "unknown": group["count"] for group in groups}
+
+    def total(facet) -> int:
+        return facet[0]["count"] if facet else 0
+
+    last_seen = {}
+    for band in facets["last_seen"]:
+        if band["_id"] == "never":
+            last_seen["never"] = band["count"]
+            continue
+        # the buckets are named after their lower bound, the oldest band holds everything older
+        age = now - band["_id"]
+        older_bands = [seconds for seconds in LAST_SEEN_BANDS if seconds >= age]
+        last_seen["<" + str(older_bands[0]) + "s" if older_bands else ">=" + str(LAST_SEEN_BANDS[-1]) + "s"] = \
+            band["count"]
+
+    temperature = {}
+    for band in facets["temperature"]:
+        if band["_id"] == "unknown":
+            temperature["unknown"] = band["count"]
+            continue
+        upper = [limit for limit in TEMPERATURE_BANDS if limit > band["_id"]]
+        lower = [limit for limit in TEMPERATURE_BANDS if limit <= band["_id"]]
+        if not lower:
+            key = "<" + str(upper[0])
+        elif not upper:
+            key = ">=" + str(lower[-1])
+        else:
+            key = str(lower[-1]) + "-" + str(upper[0])
+        temperature[key] = band["count"]
+
+    sensors = total(facets["total"])
+    online = total(facets["online"])
+    return {
+        "time": now,
+        "sensors": sensors,
+        "online": online,
+        "offline": sensors - online,
+        "last_seen": last_seen,
+        "LTE": counts(facets["LTE"]),
+        "WiFi": counts(facets["WiFi"]),
+        "Ethernet": counts(facets["Ethernet"]),
+        "os_version": counts(facets["os_version"]),
+        "temperature_celsius": temperature,
+    }
+
+
+# jobs: names of the jobs in the job list of the sensor, see load_sensor_job_lists
+def sensor_helper(sensor, jobs: list) -> dict:
     temp_status = sensor_default_status_dict.copy()
     for key in sensor["status"].keys():
         temp_status[key] = sensor["status"][key]
     return {
         "id": str(sensor["_id"]),
         "sensor_name": sensor["sensor_name"],
-        "jobs": sensor["jobs"],
+        "jobs": jobs,
         "status": temp_status
     }
 
 
-def fixed_jobs_helper(fixed_job) -> dict:
+# assignments: the job assignments of the fixed job (see load_fixed_job_assignments), they make up its sensors and
+# the states of the sensors that reported one
+def fixed_jobs_helper(fixed_job, assignments: list) -> dict:
     return {
         "id": str(fixed_job["_id"]),
         "name": fixed_job["name"],
@@ -86,12 +304,92 @@ def fixed_jobs_helper(fixed_job) -> dict:
         "end_time": fixed_job["end_time"],
         "command": fixed_job["command"],
         "arguments": fixed_job["arguments"],
-        "sensors": fixed_job["sensors"],
+        "sensors": [assignment["sensor_name"] for assignment in assignments],
         "status": fixed_job["status"],
-        "states": fixed_job["states"],
+        "states": {assignment["sensor_name"]: assignment["state"]
+                   for assignment in assignments if assignment["state"] is not None},
+    }
+
+
+# new assignment of a sensor to a fixed job, the sensor has no state yet and the job isn't in its job list
+def job_assignment_entry(fixed_job: dict, sensor_name: str, now: datetime) -> dict:
+    return {
+        "job_id": fixed_job["_id"],
+        "job_name": fixed_job["name"],
+        "sensor_name": sensor_name,
+        "state": None,
+        "listed": False,
+        "created": now,
+        "updated": now,
     }
 
 
+# State of a sensor within a fixed job: states are reported with a prefix ("running", "finished", "failed"),
+# every other value counts as pending. None if the sensor has no state.
+def job_state_of(value):
+    if value is None:
+        return None
+    for state in ["failed", "finished", "running"]:
+        if value.startswith(state):
+            return state
+    return "pending"
+
+
+# Status of a fixed job from the state counters of its sensors:
+# if at least one state is failed -> failed
+# if all states are finished -> finished
+# otherwise if at least one state is running -> running
+# else it stays as it is (pending)
+def job_status_of(state_counts: dict, status: str) -> str:
+    if state_counts["failed"] > 0:
+        return "failed"
+    if state_counts["finished"] == sum(state_counts.values()):
+        return "finished"
+    if state_counts["running"] > 0:
+        return "running"
+    return status
+
+
+# job_state_of as aggregation expression
+def job_state_expression(value) -> dict:
+    return {"$switch": {
+        "branches": [{"case": {"$eq": [{"$substrCP": [{"$ifNull": [value, ""]}, 0, len(state)]}, state]}, "then": state}
+                     for state in ["failed", "finished", "running"]],
+        "default": {"$cond": [{"$gt": [value, None]}, "pending", None]},  # missing and null sort before strings
+    }}
+
+
+# job_status_of as aggregation expression
+def job_status_expression(state_counts, status) -> dict:
+    return {"$switch": {
+        "branches": [
+            {"case": {"$gt": [state_counts + ".failed", 0]}, "then": "failed"},
+            {"case": {"$eq": [state_counts + ".finished",
+                              {"$add": [state_counts + "." + state for state in FIXED_JOB_STATES]}]},
+             "then": "finished"},
+            {"case": {"$gt": [state_counts + ".running", 0]}, "then": "running"},
+        ],
+        "default": status,
+    }}
+
+
+# count the states of the matching fixed jobs again from their assignments after their states were changed
+async def recount_fixed_job_states(query: dict):
+    job_ids = await fixed_jobs_collection.distinct("_id", query)
+    if not job_ids:
+        return
+    state_counts = {job_id: dict.fromkeys(FIXED_JOB_STATES, 0) for job_id in job_ids}
+    pipeline = [
+        {"$match": {"job_id": {"$in": job_ids}, "state": {"$ne": None}}},
+        {"$group": {"_id": {"job_id": "$job_id", "state": job_state_expression("$state")}, "count": {"$sum": 1}}},
+    ]
+    async for count in job_assignments_collection.aggregate(pipeline):
+        state_counts[count["_id"]["job_id"]][count["_id"]["state"]] = count["count"]
+    await fixed_jobs_collection.bulk_write(
+        [pymongo.UpdateOne({"_id": job_id}, {"$set": {"state_counts": counts}}) for job_id, counts in state_counts.items()],
+        ordered=False)
+
+
 def refresh_token_helper(ref_token) -> dict:
     return {
         "jti": str(ref_token["jti"]),
@@ -169,6 +467,61 @@ def is_allowed_user_role(in_role) -> bool:
         return False
 
 
+# create the indexes the queries below rely on, called once on startup (creating an existing index is a no-op)
+async def ensure_indexes():
+    # at most one open upload session per sensor, job and file
+    await upload_sessions_collection.create_index(
+        [("sensor_name", pymongo.ASCENDING), ("job_id", pymongo.ASCENDING), ("file_name", pymongo.ASCENDING)],
+        unique=True, partialFilterExpression={"state": "open"})
+    # used by the reaper to find idle upload sessions
+    await upload_sessions_collection.create_index([("updated", pymongo.ASCENDING)])
+    # sensor data filtered by sensor and/or job, in upload order (the time range is a range on _id)
+    await data_collection.create_index([("sensor_name", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+    await data_collection.create_index([("job_name", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+    await data_collection.create_index(
+        [("sensor_name", pymongo.ASCENDING), ("job_name", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+    # the sensors are updated by name, e.g. by the status updates
+    await sensors_collection.create_index([("sensor_name", pymongo.ASCENDING)])
+    # one assignment per fixed job and sensor, the assignments of a job are loaded together
+    await job_assignments_collection.create_index(
+        [("job_id", pymongo.ASCENDING), ("sensor_name", pymongo.ASCENDING)], unique=True)
+    # the job list of a sensor in the order the jobs were added, also the jobs a sensor is assigned to
+    await job_assignments_collection.create_index(
+        [("sensor_name", pymongo.ASCENDING), ("listed", pymongo.ASCENDING), ("created", pymongo.ASCENDING)])
+    # assignments whose state is not counted by their job yet, see repair_fixed_job_state_counts
+    await job_assignments_collection.create_index(
+        [("reported", pymongo.ASCENDING)], partialFilterExpression={"counted": False})
+    # state reports of sensors that still send the job name instead of the job id
+    await job_assignments_collection.create_index([("job_name", pymongo.ASCENDING), ("sensor_name", pymongo.ASCENDING)])
+    # used by the workers to find the job lists that changed
+    await job_versions_collection.create_index([("updated", pymongo.ASCENDING)])
+    # sensors by their last contact, e.g. for the online count of the fleet summary
+    await sensors_collection.create_index([("status.status_time", pymongo.ASCENDING)])
+    # the status history is a time-series collection (MongoDB >= 5.0), which stores the heartbeats of a sensor in
+    # compressed buckets. Old heartbeats are deleted after status_history_retention_days (0 = never).
+    if sensor_status_history_collection.name not in await database.list_collection_names():
+        options = {"timeseries": {"timeField": "time", "metaField": "sensor_name", "granularity": "minutes"}}
+        if sensor_status_settings.status_history_retention_days:
+            options["expireAfterSeconds"] = sensor_status_settings.status_history_retention_days * 24 * 3600
+        try:
+            await database.create_collection(sensor_status_history_collection.name, **options)
+        except pymongo.errors.CollectionInvalid:
+            pass  # created by another worker in the meantime
+        except pymongo.errors.OperationFailure as e:
+            # older MongoDB versions have no time-series collections: the heartbeats are stored one by one in a plain
+            # collection and old ones are deleted by a TTL index
+            print(f"startup: the status history is not a time-series collection, that needs MongoDB >= 5.0 ({e})")
+            if "expireAfterSeconds" in options:
+                await sensor_status_history_collection.create_index(
+                    [("time", pymongo.ASCENDING)], expireAfterSeconds=options["expireAfterSeconds"])
+    await sensor_status_history_collection.create_index(
+        [("sensor_name", pymongo.ASCENDING), ("time", pymongo.ASCENDING)])
+    # used by the timer that marks sensors offline
+    await sensor_locations_collection.create_index([("online", pymongo.ASCENDING), ("status_time", pymongo.ASCENDING)])
+    # viewport queries of the map, sensors without a position have no "location" and are not indexed
+    await sensor_locations_collection.create_index([("location", pymongo.GEOSPHERE)])
+
+
 # CRUD operations: async create, read, update and delete in the database via motor
 
 # -----------------------------------------
@@ -185,9 +538,46 @@ async def retrieve_all_data():
     return all_data
 
 
+# Build the query for sensor data of a sensor and/or job, uploaded between start_time and end_time (unix timestamps).
+# The upload time is taken from the ObjectId, so the time range is served by the default index on _id.
+def data_filter_query(sensor_name: str = None, job_name: str = None, start_time: int = None, end_time: int = None) -> dict:
+    query = {}
+    if sensor_name is not None:
+        query["sensor_name"] = sensor_name
+    if job_name is not None:
+        query["job_name"] = job_name
+    if start_time is not None or end_time is not None:
+        query["_id"] = {}
+        if start_time is not None:
+            query["_id"]["$gte"] = ObjectId.from_datetime(datetime.fromtimestamp(start_time, timezone.utc))
+        if end_time is not None:
+            query["_id"]["$lt"] = ObjectId.from_datetime(datetime.fromtimestamp(end_time + 1, timezone.utc))
+    return query
+
+
+# Iterate over the sensor data matching the filters one document at a time, without loading the whole result.
+# The data is sorted by upload time and starts behind the data with the id after_id, which makes it a page of
+# at most limit entries. fields selects the fields that are returned (see data_fields), default is all of them.
+async def iterate_data(sensor_name: str = None, job_name: str = None, start_time: int = None, end_time: int = None,
+                       after_id: str = None, newest_first: bool = False, limit: int = None, fields: list = None):
+    query = data_filter_query(sensor_name, job_name, start_time, end_time)
+    if after_id is not None:
+        query = {"$and": [query, {"_id": {"$lt" if newest_first else "$gt": ObjectId(after_id)}}]}
+    projection = None
+    if fields is not None:
+        projection = dict.fromkeys(fields, 1)
+    cursor = data_collection.find(query, projection)
+    cursor = cursor.sort("_id", pymongo.DESCENDING if newest_first else pymongo.ASCENDING)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    async for data in cursor:
+        yield data_helper(data) if fields is None else data_projection_helper(data, fields)
+
+
 # Add new sensor data dict to database
 async def add_data(sensor_data: dict) -> dict:
     data = await data_collection.insert_one(sensor_data)
+    await change_storage_usage(sensor_data["sensor_name"], stored_bytes=round(sensor_data["size"] * 1000))
     new_data = await data_collection.find_one({"_id": data.inserted_id})
     return data_helper(new_data)
 
@@ -199,23 +589,222 @@ async def retrieve_data(_id: str) -> dict:
         return data_helper(data)
 
 
-# Delete data from database
-async def delete_data(_id: str):
-    data = await data_collection.find_one({"_id": ObjectId(_id)})
-    name = data["file_name"]
+# Iterate over the sensor data whose file is not stored as blob yet (uploads before the content-addressed storage)
+async def iterate_legacy_data():
+    async for data in data_collection.find({"blob": {"$ne": True}}).sort("_id", pymongo.ASCENDING):
+        yield data_helper(data)
+
+
+# Point sensor data at the blob of content_hash, returns False if the data doesn't exist (anymore) or is a blob already
+async def set_data_blob(_id: str, content_hash: str, codec: str = None) -> bool:
+    result = await data_collection.update_one({"_id": ObjectId(_id), "blob": {"$ne": True}},
+                                              {"$set": {"blob": True, "content_hash": content_hash, "codec": codec}})
+    return result.modified_count == 1
+
+
+# Delete data from database, returns the deleted data. The blob reference of the data is not released here.
+async def delete_data(_id: str) -> dict:
+    data = await data_collection.find_one_and_delete({"_id": ObjectId(_id)})
     if data:
-        await data_collection.delete_one({"_id": ObjectId(_id)})
-        return name
+        await change_storage_usage(data["sensor_name"], stored_bytes=-round(data["size"] * 1000))
+        return data_helper(data)
 
 
 # Delete all data from db
 async def delete_all_data_db():
     result = await data_collection.delete_many({})
+    await blobs_collection.delete_many({})
+    await storage_usage_collection.update_many({}, {"$set": {"stored_bytes": 0}})
     if result:
         return True
     return False
 
 
+# -----------------------------------------
+# ----------- BLOB METHODS ----------------
+# -----------------------------------------
+# Files are stored once per content (sha256). A blob counts the data entries that reference it,
+# the file is deleted when the last reference is released. While its file is deleted the blob is marked "deleting",
+# new references wait until the file and the blob are gone, so they can't end up pointing at a deleted file.
+
+# Add a reference to the blob with this content, returns the blob. A new blob is stored with codec, an existing blob
+# keeps the codec its file was stored with.
+async def reference_blob(content_hash: str, size: int, codec: str = None) -> dict:
+    while True:
+        try:
+            blob = await blobs_collection.find_one_and_update(
+                {"_id": content_hash, "deleting": {"$exists": False}},
+                {"$inc": {"refcount": 1}, "$setOnInsert": {"size": size, "codec": codec}},
+                upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+            return blob_helper(blob)
+        except pymongo.errors.DuplicateKeyError:
+            # the file of the blob is being deleted. A deletion that takes too long was interrupted, its blob is
+            # dropped, the callers check whether the file is still there.
+            stale = datetime.now(timezone.utc) - timedelta(seconds=BLOB_DELETION_TIMEOUT)
+            await blobs_collection.delete_one({"_id": content_hash, "deleting": {"$lt": stale}})
+            await asyncio.sleep(BLOB_DELETION_WAIT)
+
+
+# Remove a reference from a blob, returns True if it was the last one: the blob is marked "deleting" then, the caller
+# has to delete the file and call forget_blob afterwards
+async def release_blob(content_hash: str) -> bool:
+    blob = await blobs_collection.find_one_and_update(
+        {"_id": content_hash}, {"$inc": {"refcount": -1}}, return_document=pymongo.ReturnDocument.AFTER)
+    if blob and blob["refcount"] <= 0:
+        marked = await blobs_collection.update_one(
+            {"_id": content_hash, "refcount": {"$lte": 0}, "deleting": {"$exists": False}},
+            {"$set": {"deleting": datetime.now(timezone.utc)}})
+        return marked.modified_count == 1
+    return False
+
+
+# Delete a blob marked by release_blob after its file was deleted
+async def forget_blob(content_hash: str):
+    await blobs_collection.delete_one({"_id": content_hash, "deleting": {"$exists": True}})
+
+
+# Switch a blob whose file got lost to a new file stored with codec, together with the data entries of its content.
+# Returns False if the codec of the blob was changed in the meantime.
+async def replace_blob_codec(content_hash: str, old_codec: str, codec: str) -> bool:
+    replaced = await blobs_collection.update_one(
+        {"_id": content_hash, "codec": old_codec, "deleting": {"$exists": False}}, {"$set": {"codec": codec}})
+    if not replaced.modified_count:
+        return False
+    await data_collection.update_many({"content_hash": content_hash, "blob": True}, {"$set": {"codec": codec}})
+    return True
+
+
+# Retrieve the blob with this content, if it is stored
+async def retrieve_blob(content_hash: str) -> dict:
+    blob = await blobs_collection.find_one({"_id": content_hash, "refcount": {"$gt": 0}})
+    if blob:
+        return blob_helper(blob)
+
+
+# -----------------------------------------
+# ----------- UPLOAD SESSION METHODS ------
+# -----------------------------------------
+
+# Return the open upload session of a sensor for a file, a new session is created if there is none.
+# An open session with a different chunk count is returned unchanged, the caller has to check that.
+async def open_upload_session(sensor_name: str, job_id: str, file_name: str, chunk_count: int) -> dict:
+    now = datetime.now(timezone.utc).timestamp()
+    query = {"sensor_name": sensor_name, "job_id": job_id, "file_name": file_name, "state": "open"}
+    new_session = {"chunk_count": chunk_count, "received": [], "created": now, "updated": now}
+    try:
+        session = await upload_sessions_collection.find_one_and_update(
+            query, {"$setOnInsert": new_session}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    except pymongo.errors.DuplicateKeyError:  # a parallel request created the session in the meantime
+        session = await upload_sessions_collection.find_one(query)
+    return upload_session_helper(session)
+
+
+# Retrieve upload session with matching ID
+async def retrieve_upload_session(_id: str) -> dict:
+    if not ObjectId.is_valid(_id):
+        return None
+    session = await upload_sessions_collection.find_one({"_id": ObjectId(_id)})
+    if session:
+        return upload_session_helper(session)
+
+
+# Add an upload session that is already complete, e.g. because the file was stored before
+async def add_complete_upload_session(sensor_name: str, job_id: str, file_name: str, chunk_count: int,
+                                      data_id: str) -> dict:
+    now = datetime.now(timezone.utc).timestamp()
+    result = await upload_sessions_collection.insert_one(
+        {"sensor_name": sensor_name, "job_id": job_id, "file_name": file_name, "chunk_count": chunk_count,
+         "received": [], "state": "complete", "data_id": data_id, "created": now, "updated": now})
+    session = await upload_sessions_collection.find_one({"_id": result.inserted_id})
+    return upload_session_helper(session)
+
+
+# Mark a chunk of an upload session as received and count its bytes as temporary storage of the sensor.
+# Returns None if the chunk was already received.
+async def add_received_chunk(_id: str, chunk_nr: int, chunk_size: int) -> dict:
+    session = await upload_sessions_collection.find_one_and_update(
+        {"_id": ObjectId(_id), "received": {"$ne": chunk_nr}},
+        {"$addToSet": {"received": chunk_nr}, "$inc": {"bytes": chunk_size},
+         "$set": {"updated": datetime.now(timezone.utc).timestamp()}},
+        return_document=pymongo.ReturnDocument.AFTER)
+    if session:
+        await change_storage_usage(session["sensor_name"], temp_bytes=chunk_size)
+        return upload_session_helper(session)
+
+
+# Change the state of an open upload session to "finalizing". Only one request can do that, so a file
+# is stored exactly once even if several chunks complete the session at the same time.
+async def claim_upload_session(_id: str) -> bool:
+    session = await upload_sessions_collection.find_one_and_update(
+        {"_id": ObjectId(_id), "state": "open"},
+        {"$set": {"state": "finalizing", "updated": datetime.now(timezone.utc).timestamp()}})
+    return session is not None
+
+
+# Mark an upload session as complete, its chunks are no longer counted as temporary storage
+async def complete_upload_session(_id: str, data_id: str):
+    session = await upload_sessions_collection.find_one_and_update(
+        {"_id": ObjectId(_id)},
+        {"$set": {"state": "complete", "data_id": data_id, "updated": datetime.now(timezone.utc).timestamp()}})
+    if session:
+        await change_storage_usage(session["sensor_name"], temp_bytes=-session.get("bytes", 0))
+
+
+# Delete an upload session and release its temporary storage, returns the deleted session.
+# With idle_since only a session that was not updated since then is deleted.
+async def discard_upload_session(_id: str, idle_since: float = None) -> dict:
+    query = {"_id": ObjectId(_id)}
+    if idle_since is not None:
+        query["updated"] = {"$lt": idle_since}
+    session = await upload_sessions_collection.find_one_and_delete(query)
+    if session:
+        if session["state"] != "complete":
+            await change_storage_usage(session["sensor_name"], temp_bytes=-session.get("bytes", 0))
+        return upload_session_helper(session)
+
+
+# Retrieve the ids of all upload sessions that were not updated since idle_since
+async def retrieve_idle_upload_session_ids(idle_since: float) -> list:
+    session_ids = []
+    async for session in upload_sessions_collection.find({"updated": {"$lt": idle_since}}, {"_id": 1}):
+        session_ids.append(str(session["_id"]))
+    return session_ids
+
+
+# Delete all upload sessions, e.g. after all files got deleted
+async def delete_all_upload_sessions():
+    await upload_sessions_collection.delete_many({})
+    await storage_usage_collection.update_many({}, {"$set": {"temp_bytes": 0}})
+
+
+# -----------------------------------------
+# ----------- STORAGE USAGE METHODS -------
+# -----------------------------------------
+
+# Add to the bytes a sensor uses in temporary storage (chunks of running uploads) and stored files
+async def change_storage_usage(sensor_name: str, temp_bytes: int = 0, stored_bytes: int = 0):
+    await storage_usage_collection.update_one(
+        {"_id": sensor_name},
+        {"$inc": {"temp_bytes": temp_bytes, "stored_bytes": stored_bytes}},
+        upsert=True)
+
+
+# Retrieve the storage usage of a sensor in bytes
+async def retrieve_storage_usage(sensor_name: str) -> dict:
+    usage = await storage_usage_collection.find_one({"_id": sensor_name})
+    if usage:
+        return storage_usage_helper(usage)
+    return {"sensor_name": sensor_name, "temp_bytes": 0, "stored_bytes": 0}
+
+
+# Retrieve the storage usage of all sensors in bytes
+async def retrieve_all_storage_usage() -> list:
+    all_usage = []
+    async for usage in storage_usage_collection.find().sort("_id", pymongo.ASCENDING):
+        all_usage.append(storage_usage_helper(usage))
+    return all_usage
+
+
 # -----------------------------------------
 # ----------- SENSOR LIST METHODS ------------
 # -----------------------------------------
@@ -224,16 +813,55 @@ async def delete_all_data_db():
 async def retrieve_all_sensor_lists():
     all_sensors = []
     all_sensors_cursor = sensors_collection.find()
-    for sensor in await all_sensors_cursor.to_list(length=None):
-        all_sensors.append(sensor_helper(sensor))
+    sensors = await all_sensors_cursor.to_list(length=None)
+    job_lists = await load_sensor_job_lists([sensor["sensor_name"] for sensor in sensors])
+    for sensor in sensors:
+        all_sensors.append(sensor_helper(with_pending_status(sensor), job_lists.get(sensor["sensor_name"], [])))
     return all_sensors
 
+# Health summary of the fleet, computed by the db: number of sensors online (last contact less than
+# sensor_offline_after ago) and the number of sensors per last contact band, connectivity state, OS version and
+# temperature band. Status updates that are not flushed yet are not included.
+async def retrieve_sensor_summary() -> dict:
+    now = int(datetime.now(timezone.utc).timestamp())
+    online_since = now - sensor_status_settings.sensor_offline_after
+    online = await sensors_collection.count_documents({"status.status_time": {"$gt": online_since}})
+
+    def count_by(field: str) -> list:
+        return [{"$group": {"_id": "$status." + field, "count": {"$sum": 1}}}, {"$sort": {"count": -1}}]
+
+    pipeline = [
+        {"$project": {"status": 1}},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            # sensors that never sent their status have status_time 0
+            "last_seen": [{"$bucket": {
+                "groupBy": "$status.status_time",
+                "boundaries": [1] + [now - seconds for seconds in reversed(LAST_SEEN_BANDS)] + [float("inf")],
+                "default": "never",
+            }}],
+            "temperature": [{"$bucket": {
+                "groupBy": "$status.temperature_celsius",
+                "boundaries": [float("-inf")] + TEMPERATURE_BANDS + [float("inf")],
+                "default": "unknown",
+            }}],
+            "LTE": count_by("LTE"),
+            "WiFi": count_by("WiFi"),
+            "Ethernet": count_by("Ethernet"),
+            "os_version": count_by("os_version"),
+        }},
+    ]
+    facets = (await sensors_collection.aggregate(pipeline).to_list(length=None))[0]
+    facets["online"] = [{"count": online}] if online else []
+    return sensor_summary_helper(facets, now)
+
 
 # Retrieve job list with matching ID
 async def retrieve_sensor_list(_id: str) -> dict:
     sensor = await sensors_collection.find_one({"_id": ObjectId(_id)})
     if sensor:
-        return sensor_helper(sensor)
+        job_lists = await load_sensor_job_lists([sensor["sensor_name"]])
+        return sensor_helper(with_pending_status(sensor), job_lists.get(sensor["sensor_name"], []))
 
 
 # Update job list entry with matching ID
@@ -242,40 +870,49 @@ async def update_sensor(_id: str, jobs: dict):
         return False
 
     # check if the pointers are valid, if a pending fixed job isn't found the operation fails
-    for job in jobs["jobs"]:
-        fixed_job = await fixed_jobs_collection.find_one({"name": job, "status": "pending"})
-        if not fixed_job:
-            return False
+    fixed_jobs = await fixed_jobs_collection.find(
+        {"name": {"$in": jobs.get("jobs", [])}, "status": "pending"}, {"name": 1}).to_list(length=None)
+    if len(fixed_jobs) < len(set(jobs.get("jobs", []))):
+        return False
 
     # check if sensor exists and update it
     sensor_db = await sensors_collection.find_one({"_id": ObjectId(_id)})
     if sensor_db:
         sensor_name = sensor_db["sensor_name"]
-        updated_sensors = await sensors_collection.update_one({"_id": ObjectId(_id)}, {"$set": jobs})
+        new_name = jobs.get("sensor_name", sensor_name)
+        if new_name != sensor_name and await check_sensorName_exists(new_name):
+            return False
+        # the job list itself is made of the assignments of the sensor
+        updated_sensors = True
+        sensor_fields = {key: value for key, value in jobs.items() if key != "jobs"}
+        if sensor_fields:
+            updated_sensors = await sensors_collection.update_one({"_id": ObjectId(_id)}, {"$set": sensor_fields})
+            if new_name != sensor_name:
+                # the assignments, the status and the position move with the sensor
+                await job_assignments_collection.update_many(
+                    {"sensor_name": sensor_name}, {"$set": {"sensor_name": new_name}})
+                await rename_sensor_status(sensor_name, new_name)
+                await increase_job_versions([new_name])
+                sensor_name = new_name
+        if "jobs" not in jobs:
+            return bool(updated_sensors)  # only the name changed
+        # jobs that are not in the new job list are removed from it
+        await job_assignments_collection.update_many(
+            {"sensor_name": sensor_name, "listed": True, "job_name": {"$nin": jobs["jobs"]}},
+            {"$set": {"listed": False, "updated": datetime.now(timezone.utc)}})
 
         # special case: update job list is empty - implies 'clear jobs'.
         # Sensor has to be removed from all pending fixed jobs
         if not jobs["jobs"]:
-            await fixed_jobs_collection.update_many(
-                {"status": "pending"},
-                {"$pull": {"sensors": sensor_name}}
-            )
-            await fixed_jobs_collection.update_many(
-                {"status": "pending"},
-                {"$unset": {"states." + sensor_name: ""}}
-            )
+            pending_job_ids = await pending_fixed_job_ids_of_sensor(sensor_name)
+            await job_assignments_collection.delete_many({"sensor_name": sensor_name, "job_id": {"$in": pending_job_ids}})
+            await recount_fixed_job_states({"_id": {"$in": pending_job_ids}})
+            await increase_job_versions()
         else:
-            # add sensor pointer to all pending fixed jobs that were added
-            await fixed_jobs_collection.update_many(
-                {"name": {"$in": jobs["jobs"]}, "status": "pending"},
-                {"$addToSet": {"sensors": sensor_name}}
-            )
-
-            # add pending state for the sensor to all jobs that were added
-            await fixed_jobs_collection.update_many(
-                {"name": {"$in": jobs["jobs"]}, "status": "pending"},
-                {"$set": {"states." + sensor_name: "pending"}}
-            )
+            # assign the sensor to all pending fixed jobs that were added, with pending state
+            await assign_sensors(fixed_jobs, [sensor_name])
+            await recount_fixed_job_states({"_id": {"$in": [fixed_job["_id"] for fixed_job in fixed_jobs]}})
+            await increase_job_versions(await fixed_job_sensor_names({"name": {"$in": jobs["jobs"]}}))
 
         if updated_sensors:
             return True
@@ -287,33 +924,17 @@ async def update_all_sensors(jobs: [str]):
     if len(jobs) < 1:
         return False
     # check if the pointers are valid, if a pending fixed job isn't found the operation fails
-    for job in jobs:
-        fixed_job = await fixed_jobs_collection.find_one({"name": job, "status": "pending"})
-        if not fixed_job:
-            return False
-    # push each of the input jobs to all collection items into the "sensors" array
-    updated_sensors = await sensors_collection.update_many(
-        {},
-        {"$push": {"jobs": {"$each": jobs}}}
-    )
+    fixed_jobs = await fixed_jobs_collection.find(
+        {"name": {"$in": jobs}, "status": "pending"}, {"name": 1}).to_list(length=None)
+    if len(fixed_jobs) < len(set(jobs)):
+        return False
 
-    # update fixed jobs with new sensor pointers:
-    sensors_cursor = sensors_collection.find()  # cursor containing all sensors
-    sensor_names = []
     # compile list of all sensor_names
-    for sensor in await sensors_cursor.to_list(length=None):
-        sensor_names.append(sensor["sensor_name"])
-    # add sensor_names to added fixed jobs
-    await fixed_jobs_collection.update_many(
-        {"name": {"$in": jobs}, "status": "pending"},
-        {"$addToSet": {"sensors": {"$each": sensor_names}}}
-    )
-    # add pending state for each sensor to states
-    for sensor in sensor_names:
-        await fixed_jobs_collection.update_many(
-            {"name": {"$in": jobs}, "status": "pending"},
-            {"$set": {"states." + sensor: "pending"}}
-        )
+    sensor_names = await sensors_collection.distinct("sensor_name")
+    # assign all sensors to the added fixed jobs, with pending state
+    updated_sensors = await assign_sensors(fixed_jobs, sensor_names)
+    await recount_fixed_job_states({"_id": {"$in": [fixed_job["_id"] for fixed_job in fixed_jobs]}})
+    await increase_job_versions()
 
     if updated_sensors:
         return True
@@ -322,39 +943,289 @@ async def update_all_sensors(jobs: [str]):
 
 # Clear all sensor lists
 async def clear_all_sensors():
-    cleared_jobs = await sensors_collection.update_many(
-        {},
-        {"$set": {"jobs": []}}
+    now = datetime.now(timezone.utc)
+    cleared_jobs = await job_assignments_collection.update_many(
+        {"listed": True},
+        {"$set": {"listed": False, "updated": now}}
     )
-    # clear sensor pointers of all pending fixed jobs and clear all states
+    # remove all sensors from all pending fixed jobs and clear all states
+    pending_job_ids = await fixed_jobs_collection.distinct("_id", {"status": "pending"})
+    await job_assignments_collection.delete_many({"job_id": {"$in": pending_job_ids}})
     await fixed_jobs_collection.update_many(
-        {"status": "pending"},
-        {"$set": {"sensors": [], "states": {}}}
+        {"_id": {"$in": pending_job_ids}},
+        {"$set": {"state_counts": dict.fromkeys(FIXED_JOB_STATES, 0)}}
     )
+    await increase_job_versions()
     if cleared_jobs:
         return True
     return False
 
-
-# Add new sensor with empty job list to database, if its name doesn't already exist
+# Update the status of a sensor. The status is only validated and buffered here, it is written to the db by the
+# next flush_sensor_status. The db is only queried for the first status of a sensor, to check that it exists.
 async def write_sensor_status(name: str, new_status: dict):
     if not uses_allowed_characters(name):
         return "invalid sensor name"
-    sensor_to_update = await sensors_collection.find_one({"sensor_name": name})
-    if sensor_to_update:
-        # ensure that only valid keys and states enter the db
-        status_update = sensor_default_status_dict.copy()
-        for key in new_status.keys():
-            if uses_allowed_characters(key) and key in status_update.keys() and uses_allowed_characters(
-                    new_status[key]):
-                status_update[key] = new_status[key]
-            else:
-                return "invalid status-argument: " + str(key) + ":" + str(new_status[key])
-        updated_sensors = await sensors_collection.update_one({"sensor_name": name},
-                                                              {"$set": {"status": status_update}})
-        if updated_sensors:
-            return name
-    return "sensor not found"
+    # ensure that only valid keys and states enter the db
+    status_update = sensor_default_status_dict.copy()
+    for key in new_status.keys():
+        if uses_allowed_characters(key) and key in status_update.keys() and uses_allowed_characters(
+                new_status[key]):
+            status_update[key] = new_status[key]
+        else:
+            return "invalid status-argument: " + str(key) + ":" + str(new_status[key])
+    if name not in known_sensor_names:
+        if not await sensors_collection.find_one({"sensor_name": name}, {"_id": 1}):
+            return "sensor not found"
+        known_sensor_names.add(name)
+    pending_sensor_status[name] = status_update
+    pending_sensor_history.append(sensor_history_entry(name, status_update))
+    if len(pending_sensor_history) >= sensor_status_settings.status_flush_max_entries:
+        sensor_status_flush_needed.set()
+    return name
+
+
+# Write the buffered status updates to the db with a single unordered bulk_write, returns the number of sensors.
+# Updates that fail stay buffered, unless a newer status arrived in the meantime.
+async def flush_sensor_status() -> int:
+    global pending_sensor_status
+    if not pending_sensor_status:
+        return 0
+    flushed, pending_sensor_status = pending_sensor_status, {}
+    names = list(flushed.keys())
+    requests = [pymongo.UpdateOne({"sensor_name": name}, {"$set": {"status": flushed[name]}}) for name in names]
+    try:
+        written = await sensors_collection.bulk_write(requests, ordered=False)
+        if written.matched_count < len(names):
+            # sensors that were deleted or renamed in the meantime, e.g. by another worker, are forgotten
+            existing = set(await sensors_collection.distinct("sensor_name", {"sensor_name": {"$in": names}}))
+            forget_sensor_status([name for name in names if name not in existing])
+            flushed = {name: status for name, status in flushed.items() if name in existing}
+        if flushed:
+            await write_sensor_locations(flushed)
+    except pymongo.errors.BulkWriteError as ex:
+        for error in ex.details["writeErrors"]:
+            name = names[error["index"]]
+            pending_sensor_status.setdefault(name, flushed[name])
+        raise
+    except Exception:
+        for name, status in flushed.items():
+            pending_sensor_status.setdefault(name, status)
+        raise
+    return len(flushed)
+
+
+# Append the buffered heartbeats to the status history, returns their number.
+# If the insert fails, the heartbeats that were not written are buffered again.
+async def flush_sensor_status_history() -> int:
+    global pending_sensor_history
+    if not pending_sensor_history:
+        return 0
+    flushed, pending_sensor_history = pending_sensor_history, []
+    try:
+        await sensor_status_history_collection.insert_many(flushed, ordered=False)
+    except pymongo.errors.BulkWriteError as ex:
+        failed = {error["index"] for error in ex.details["writeErrors"]}
+        pending_sensor_history = [entry for nr, entry in enumerate(flushed) if nr in failed] + pending_sensor_history
+        raise
+    except Exception:
+        pending_sensor_history = flushed + pending_sensor_history
+        raise
+    return len(flushed)
+
+
+# Drop the buffered status updates of sensors that don't exist anymore, their next heartbeat looks them up again
+def forget_sensor_status(names: list):
+    global pending_sensor_history
+    for name in names:
+        known_sensor_names.discard(name)
+        pending_sensor_status.pop(name, None)
+    pending_sensor_history = [entry for entry in pending_sensor_history if entry["sensor_name"] not in names]
+
+
+# Move the buffered status, the map position and the status history of a renamed sensor to its new name
+async def rename_sensor_status(name: str, new_name: str):
+    known_sensor_names.discard(name)
+    known_sensor_names.add(new_name)
+    if name in pending_sensor_status:
+        pending_sensor_status[new_name] = pending_sensor_status.pop(name)
+    for entry in pending_sensor_history:
+        if entry["sensor_name"] == name:
+            entry["sensor_name"] = new_name
+    await sensor_status_history_collection.update_many({"sensor_name": name}, {"$set": {"sensor_name": new_name}})
+    location = await sensor_locations_collection.find_one_and_delete({"_id": name})
+    if location:
+        await sensor_locations_collection.replace_one({"_id": new_name}, {**location, "_id": new_name}, upsert=True)
+        await increase_sensor_locations_version()
+
+
+# Downsampled status history of a sensor (or of all sensors if sensor_name is None) from start_time to end_time
+# (unix timestamps): min/avg/max per bucket of bucket_seconds, computed by the db. Empty buckets are left out.
+async def retrieve_sensor_status_history(sensor_name: str, start_time: int, end_time: int,
+                                         bucket_seconds: int) -> list:
+    query = {"time": {"$gte": datetime.fromtimestamp(start_time, timezone.utc),
+                      "$lt": datetime.fromtimestamp(end_time, timezone.utc)}}
+    if sensor_name is not None:
+        query["sensor_name"] = sensor_name
+    # start of the bucket: the time rounded down to a multiple of bucket_seconds
+    bucket_start = {"$subtract": ["$time", {"$mod": [{"$toLong": "$time"}, bucket_seconds * 1000]}]}
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": bucket_start,
+            "heartbeats": {"$sum": 1},
+            "sensors": {"$addToSet": "$sensor_name"},
+            "temperature_min": {"$min": "$temperature"},
+            "temperature_avg": {"$avg": "$temperature"},
+            "temperature_max": {"$max": "$temperature"},
+            "LTE_online": {"$avg": "$LTE"},
+            "WiFi_online": {"$avg": "$WiFi"},
+            "Ethernet_online": {"$avg": "$Ethernet"},
+            "lat_avg": {"$avg": "$lat"},
+            "lon_avg": {"$avg": "$lon"},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+    buckets = sensor_status_history_collection.aggregate(pipeline)
+    return [status_history_bucket_helper(bucket) async for bucket in buckets]
+
+
+# -----------------------------------------
+# ----------- SENSOR LOCATION METHODS -----
+# -----------------------------------------
+# The map positions of the sensors live in sensor_locations, which every worker updates when it writes status
+# updates. The version in versions_collection is increased whenever the map changes, so the workers can cache the
+# map and clients can revalidate it with its ETag.
+
+async def retrieve_sensor_locations_version() -> int:
+    version = await versions_collection.find_one({"_id": "sensor_locations"})
+    if version:
+        return version["version"]
+    return 0
+
+
+async def increase_sensor_locations_version():
+    await versions_collection.update_one({"_id": "sensor_locations"}, {"$inc": {"version": 1}}, upsert=True)
+
+
+# Update the map positions of the sensors from their new status (sensor name -> status)
+async def write_sensor_locations(statuses: dict):
+    locations = {name: sensor_location_entry(status) for name, status in statuses.items()}
+    # the last contact is written for every sensor, the version is only increased if a point on the map changed
+    await sensor_locations_collection.bulk_write(
+        [pymongo.UpdateOne({"_id": name}, {"$set": {"status_time": location["status_time"]},
+                                           "$setOnInsert": {"lat": None, "lon": None, "online": False}},
+                           upsert=True)
+         for name, location in locations.items()], ordered=False)
+    requests = []
+    for name, location in locations.items():
+        changed_filter = {"_id": name, "$or": [{"lat": {"$ne": location["lat"]}},
+                                               {"lon": {"$ne": location["lon"]}},
+                                               {"online": {"$ne": location["online"]}}]}
+        update = {"$set": {"lat": location["lat"], "lon": location["lon"], "online": location["online"]}}
+        if location["location"] is not None:
+            changed_filter["$or"].append({"location": {"$ne": location["location"]}})
+            update["$set"]["location"] = location["location"]
+        else:
+            # the geo index only accepts valid points, a sensor without position has no "location"
+            changed_filter["$or"].append({"location": {"$exists": True}})
+            update["$unset"] = {"location": ""}
+        requests.append(pymongo.UpdateOne(changed_filter, update))
+    changed = await sensor_locations_collection.bulk_write(requests, ordered=False)
+    if changed.modified_count:
+        await increase_sensor_locations_version()
+
+
+# Mark the sensors offline that had no contact for sensor_offline_after, called on a timer
+async def mark_offline_sensor_locations():
+    offline_since = datetime.now(timezone.utc).timestamp() - sensor_status_settings.sensor_offline_after
+    marked = await sensor_locations_collection.update_many({"online": True, "status_time": {"$lte": offline_since}},
+                                                           {"$set": {"online": False}})
+    if marked.modified_count:
+        await increase_sensor_locations_version()
+
+
+async def delete_sensor_location(name: str):
+    deleted = await sensor_locations_collection.delete_one({"_id": name})
+    if deleted.deleted_count:
+        await increase_sensor_locations_version()
+
+
+# Rebuild the map positions from the sensor list, e.g. after an update of the server. Returns the version.
+async def rebuild_sensor_locations() -> int:
+    statuses = {}
+    async for sensor in sensors_collection.find({}, {"sensor_name": 1, "status": 1}):
+        statuses[sensor["sensor_name"]] = {**sensor_default_status_dict, **with_pending_status(sensor)["status"]}
+    await sensor_locations_collection.delete_many({"_id": {"$nin": list(statuses.keys())}})
+    if statuses:
+        await write_sensor_locations(statuses)
+    await increase_sensor_locations_version()
+    return await retrieve_sensor_locations_version()
+
+
+# GeoJSON polygons that cover the longitude range west to east (west <= east) and the latitude range south to north.
+# Polygon edges are great circles, so the edges along the latitudes get a point every degree to follow them closely,
+# and wide ranges are split into strips of at most 90 degrees, a polygon has to be smaller than a hemisphere.
+def bbox_polygons(west: float, south: float, east: float, north: float) -> list:
+    south, north = max(south, -89.9), min(north, 89.9)
+    polygons = []
+    if south >= north:
+        return polygons  # no area left near a pole
+    while west < east:
+        strip_east = min(west + 90, east)
+        steps = max(int(strip_east - west), 1)
+        lons = [west + (strip_east - west) * step / steps for step in range(steps + 1)]
+        ring = [[lon, south] for lon in lons] + [[lon, north] for lon in reversed(lons)] + [[west, south]]
+        polygons.append({"type": "Polygon", "coordinates": [ring]})
+        west = strip_east
+    return polygons
+
+
+# Sensors within the bounding box (west, south, east, north in degrees, west > east crosses the antimeridian),
+# clustered on a grid with cells of cell_degrees: one entry per cell with the number of sensors, how many of them
+# are online and the center of their positions. Computed by the db, the result only depends on the viewport.
+async def retrieve_sensor_location_clusters(west: float, south: float, east: float, north: float,
+                                            cell_degrees: float) -> list:
+    lon_ranges = [(west, east)] if west <= east else [(west, 180), (-180, east)]
+    areas = []
+    for range_west, range_east in lon_ranges:
+        for polygon in bbox_polygons(range_west, south, range_east, north):
+            # the geo index finds the candidates, the ranges on lat/lon make the box exact
+            areas.append({"location": {"$geoWithin": {"$geometry": polygon}},
+                          "lon": {"$gte": range_west, "$lte": range_east}})
+    if not areas:
+        return []
+    pipeline = [
+        {"$match": {"$or": areas, "lat": {"$gte": south, "$lte": north}}},
+        {"$group": {
+            "_id": {"x": {"$floor": {"$divide": ["$lon", cell_degrees]}},
+                    "y": {"$floor": {"$divide": ["$lat", cell_degrees]}}},
+            "count": {"$sum": 1},
+            "online": {"$sum": {"$cond": ["$online", 1, 0]}},
+            "lat": {"$avg": "$lat"},
+            "lon": {"$avg": "$lon"},
+        }},
+    ]
+    clusters = sensor_locations_collection.aggregate(pipeline)
+    return [location_cluster_helper(cluster) async for cluster in clusters]
+
+
+# Returns [online positions, offline positions] as [[lat, lon], ...]
+async def retrieve_sensor_locations() -> list:
+    online_locations = []
+    offline_locations = []
+    async for location in sensor_locations_collection.find({"lat": {"$ne": None}, "lon": {"$ne": None}}):
+        if location["online"]:
+            online_locations.append([location["lat"], location["lon"]])
+        else:
+            offline_locations.append([location["lat"], location["lon"]])
+    return [online_locations, offline_locations]
+
+
+# Sensor document with the buffered status, if there is one
+def with_pending_status(sensor: dict) -> dict:
+    if sensor["sensor_name"] in pending_sensor_status:
+        return {**sensor, "status": pending_sensor_status[sensor["sensor_name"]]}
+    return sensor
 
 
 # Add new sensor with empty job list to database, if its name doesn't already exist
@@ -364,7 +1235,6 @@ async def add_sensor(_name: str):
         added_sensor = await sensors_collection.insert_one(
             {
                 "sensor_name": _name,
-                "jobs": [],
                 "status": sensor_default_status_dict
             })
         if added_sensor:
@@ -378,16 +1248,16 @@ async def delete_sensor(_name: str):
     if deleted_sensor:
         db_id = deleted_sensor["_id"]
         await sensors_collection.delete_one({"_id": db_id})
-        # remove the sensor from all pending fixed jobs
-        fixed_jobs_collection.update_many(
-            {"status": "pending"},
-            {"$pull": {"sensors": deleted_sensor["sensor_name"]}}
-        )
-        # remove sensor state from all pending fixed jobs
-        fixed_jobs_collection.update_many(
-            {"status": "pending"},
-            {"$unset": {deleted_sensor["sensor_name"]: ""}}
-        )
+        forget_sensor_status([_name])
+        await delete_sensor_location(_name)
+        # remove the sensor from all pending fixed jobs, its job list is gone with it
+        pending_job_ids = await pending_fixed_job_ids_of_sensor(_name)
+        await job_assignments_collection.delete_many({"sensor_name": _name, "job_id": {"$in": pending_job_ids}})
+        await job_assignments_collection.update_many(
+            {"sensor_name": _name, "listed": True},
+            {"$set": {"listed": False, "updated": datetime.now(timezone.utc)}})
+        await recount_fixed_job_states({"_id": {"$in": pending_job_ids}})
+        await increase_job_versions()
         return str(db_id)
     return None
 
@@ -410,21 +1280,135 @@ async def check_sensorID_exists(sensorID: str):
         return False
 
 
+# -----------------------------------------
+# ----------- JOB ASSIGNMENT METHODS ------
+# -----------------------------------------
+# The sensors of a fixed job, their states and the job lists of the sensors are stored as job assignments, so a job
+# assigned to the whole fleet doesn't become one huge document that is rewritten by every state report.
+# fixed_jobs_helper and sensor_helper assemble the old output from them.
+
+# assignments of the given fixed jobs: job id -> list of assignments in the order they were made
+async def load_fixed_job_assignments(job_ids: list) -> dict:
+    assignments = {job_id: [] for job_id in job_ids}
+    assignments_cursor = job_assignments_collection.find(
+        {"job_id": {"$in": job_ids}}, {"job_id": 1, "sensor_name": 1, "state": 1})
+    for assignment in sorted(await assignments_cursor.to_list(length=None), key=lambda entry: entry["_id"]):
+        assignments[assignment["job_id"]].append(assignment)
+    return assignments
+
+
+# fixed_jobs_helper for a list of fixed jobs, the assignments of all of them are loaded with one query
+async def fixed_jobs_with_assignments(fixed_jobs: list) -> list:
+    assignments = await load_fixed_job_assignments([fixed_job["_id"] for fixed_job in fixed_jobs])
+    return [fixed_jobs_helper(fixed_job, assignments[fixed_job["_id"]]) for fixed_job in fixed_jobs]
+
+
+# job lists of the given sensors: sensor name -> job names in the order they were added
+async def load_sensor_job_lists(sensor_names: list) -> dict:
+    job_lists = {}
+    assignments_cursor = job_assignments_collection.find(
+        {"sensor_name": {"$in": sensor_names}, "listed": True}, {"sensor_name": 1, "job_name": 1, "created": 1})
+    for assignment in sorted(await assignments_cursor.to_list(length=None),
+                             key=lambda entry: (entry["created"], entry["_id"])):
+        job_lists.setdefault(assignment["sensor_name"], []).append(assignment["job_name"])
+    return job_lists
+
+
+# Assign the sensors to the fixed jobs with pending state and add the jobs to their job lists
+async def assign_sensors(fixed_jobs: list, sensor_names: list):
+    if not fixed_jobs or not sensor_names:
+        return None
+    now = datetime.now(timezone.utc)
+    return await job_assignments_collection.bulk_write(
+        [pymongo.UpdateOne(
+            {"job_id": fixed_job["_id"], "sensor_name": sensor_name},
+            {"$set": {"job_name": fixed_job["name"], "state": "pending", "listed": True, "updated": now},
+             "$setOnInsert": {"created": now}},
+            upsert=True)
+         for fixed_job in fixed_jobs for sensor_name in sensor_names], ordered=False)
+
+
+# ids of the pending fixed jobs the sensor is assigned to
+async def pending_fixed_job_ids_of_sensor(sensor_name: str) -> list:
+    job_ids = await job_assignments_collection.distinct("job_id", {"sensor_name": sensor_name})
+    return await fixed_jobs_collection.distinct("_id", {"_id": {"$in": job_ids}, "status": "pending"})
+
+
+# Fixed jobs and sensors that still hold their assignments, see migrate_assignments.py
+def unmigrated_fixed_jobs_query() -> dict:
+    return {"$or": [{"sensors": {"$exists": True}}, {"states": {"$exists": True}}]}
+
+
+async def count_unmigrated_assignments() -> int:
+    return await fixed_jobs_collection.count_documents(unmigrated_fixed_jobs_query()) + \
+        await sensors_collection.count_documents({"jobs": {"$exists": True}})
+
+
+# Move the sensors and states of a fixed job into its assignments. The states of the job win over the assignments,
+# so a migration that is run again after an interruption gives the same result.
+async def migrate_fixed_job_assignments(fixed_job: dict) -> int:
+    sensor_names = list(dict.fromkeys(fixed_job.get("sensors", [])))
+    states = fixed_job.get("states", {})
+    if sensor_names:
+        now = datetime.now(timezone.utc)
+        await job_assignments_collection.bulk_write(
+            [pymongo.UpdateOne(
+                {"job_id": fixed_job["_id"], "sensor_name": sensor_name},
+                {"$set": {"job_name": fixed_job["name"], "state": states.get(sensor_name), "updated": now},
+                 "$setOnInsert": {"listed": False, "created": now}},
+                upsert=True)
+             for sensor_name in sensor_names], ordered=False)
+    await recount_fixed_job_states({"_id": fixed_job["_id"]})
+    await fixed_jobs_collection.update_one({"_id": fixed_job["_id"]}, {"$unset": {"sensors": "", "states": ""}})
+    return len(sensor_names)
+
+
+async def iterate_unmigrated_fixed_jobs():
+    async for fixed_job in fixed_jobs_collection.find(unmigrated_fixed_jobs_query()):
+        yield fixed_job
+
+
+# Move the job list of a sensor into the assignments. Returns the number of listed jobs and the number of jobs in
+# the list the sensor isn't assigned to, those are dropped.
+async def migrate_sensor_job_list(sensor: dict) -> (int, int):
+    job_names = list(dict.fromkeys(sensor.get("jobs", [])))
+    listed = 0
+    if job_names:
+        result = await job_assignments_collection.update_many(
+            {"sensor_name": sensor["sensor_name"], "job_name": {"$in": job_names}},
+            {"$set": {"listed": True}})
+        listed = result.matched_count
+    await sensors_collection.update_one({"_id": sensor["_id"]}, {"$unset": {"jobs": ""}})
+    return listed, len(job_names) - listed
+
+
+async def iterate_unmigrated_sensors():
+    async for sensor in sensors_collection.find({"jobs": {"$exists": True}}):
+        yield sensor
+
+
 # -----------------------------------------
 # ----------- FIXED JOB METHODS -----------
 # -----------------------------------------
 
-# add fixed job to fixed_jobs collection, add job pointer to the specified sensors,
+# add fixed job to fixed_jobs collection, assign the specified sensors to it,
 # return dict with inserted id in _id field if successful
 async def add_fixed_job(fixed_job: dict):
+    sensor_names = list(dict.fromkeys(fixed_job.pop("sensors")))
+    fixed_job.pop("states", None)  # newly assigned sensors have no state yet, the states are kept in the assignments
     fixed_job["status"] = "pending"  # newly created fixed jobs initially have status: pending
-    fixed_job["states"] = {}  # initialize empty document (key-value pairs) for the individual sensor statuses
+    fixed_job["state_counts"] = dict.fromkeys(FIXED_JOB_STATES, 0)
     # only execute when job name is unique
     already_exists = await fixed_jobs_collection.find_one({"name": fixed_job["name"]})
     if not already_exists:
         result = await fixed_jobs_collection.insert_one(fixed_job)  # returns the inserted id on success
         fixed_job_db = await fixed_jobs_collection.find_one({"_id": result.inserted_id})  # fetch the document by the id
-        return fixed_jobs_helper(fixed_job_db)
+        now = datetime.now(timezone.utc)
+        assignments = [job_assignment_entry(fixed_job_db, sensor_name, now) for sensor_name in sensor_names]
+        if assignments:
+            await job_assignments_collection.insert_many(assignments)
+        await increase_job_versions(sensor_names)
+        return fixed_jobs_helper(fixed_job_db, assignments)
     return None
 
 
@@ -432,103 +1416,251 @@ async def add_fixed_job(fixed_job: dict):
 async def set_status(name: str, status: str):
     # set the status of the first document matching 'name' to 'status'
     updated_job = await fixed_jobs_collection.update_one({"name": name}, {"$set": {"status": status}})
+    if updated_job.modified_count:
+        await increase_job_versions(await fixed_job_sensor_names({"name": name}))
     # returns a document with matchedCount, modifiedCount, upsertedId, acknowledged. See MongoDB docs for updateOne().
     return updated_job
 
 
 # set state of a sensor within a fixed job (running, finished, failed)
 # set status of a fixed job depending on sensor states
+# The state is changed in the assignment, then the state counters and the status of the job by one pipeline update.
+# The counters are only moved by the difference the state change made, so reports of many sensors of the same job
+# can't overwrite each other's results. The two updates are not atomic together (a standalone MongoDB has no
+# transactions): the assignment is marked "counted": False until the counters include its state, assignments that
+# stay marked because the second update failed are repaired by repair_fixed_job_state_counts.
 async def set_sensor_status(job_id: str, sensor: str, status: str):
     # TODO: remove backwards compatibility when sensors are all updated: check if job_id is maybe a job_name
-    maybe_job = await fixed_jobs_collection.find_one({"name": job_id})
-    if maybe_job:
-        job_id = maybe_job["_id"]
-
-    update_job = await fixed_jobs_collection.find_one({"_id": ObjectId(job_id)})
+    job_query = [{"name": job_id}]
+    assignment_query = [{"job_name": job_id}]
+    if ObjectId.is_valid(job_id):
+        job_query.append({"_id": ObjectId(job_id)})
+        assignment_query.append({"job_id": ObjectId(job_id)})
+    new_state = job_state_of(status)
+
+    # the assignment before the update tells the old state
+    reported = datetime.now(timezone.utc)
+    assignment = await job_assignments_collection.find_one_and_update(
+        {"sensor_name": sensor, "$or": assignment_query},
+        {"$set": {"state": status, "updated": reported, "reported": reported, "counted": False}},
+        projection={"job_id": 1, "state": 1})
     # check if sensor is part of that fixed job
-    if not update_job:
+    if not assignment:
+        if await fixed_jobs_collection.find_one({"$or": job_query}, {"_id": 1}):
+            return "Not included"
         return "Not found"
 
-    if sensor not in update_job["sensors"]:
-        return "Not included"
-
-    # set key-value pair for sensor in 'states', if key doesn't exist it will be created
-    result = await fixed_jobs_collection.update_one(
-        {"_id": ObjectId(job_id)},
-        {"$set": {"states." + sensor: status}}
-    )
+    # the state of the sensor moves from the counter of its old state to the counter of its new state
+    old_state = job_state_of(assignment["state"])
+    state_changes = {state: (1 if state == new_state else 0) - (1 if state == old_state else 0)
+                     for state in FIXED_JOB_STATES}
+    pipeline = [
+        {"$set": {"state_counts." + state: {"$add": [{"$ifNull": ["$state_counts." + state, 0]}, change]}
+                  for state, change in state_changes.items() if change}},
+        {"$set": {"status": job_status_expression("$state_counts", "$status")}},
+    ]
+    if not any(state_changes.values()):
+        pipeline = pipeline[1:]
+    # the job before the update, only with the fields needed to tell what changed
+    update_job = await fixed_jobs_collection.find_one_and_update(
+        {"_id": assignment["job_id"], "state_counts": {"$type": "object"}}, pipeline,
+        projection={"name": 1, "status": 1, "state_counts": 1})
+    if not update_job:
+        # a job from before the state counters has none yet: they are counted from its assignments, which already
+        # hold this report, and only its status is updated
+        await recount_fixed_job_states({"_id": assignment["job_id"]})
+        state_changes = dict.fromkeys(FIXED_JOB_STATES, 0)
+        update_job = await fixed_jobs_collection.find_one_and_update(
+            {"_id": assignment["job_id"]}, pipeline[-1:], projection={"name": 1, "status": 1, "state_counts": 1})
+    if not update_job:
+        # the job was deleted in the meantime, after its assignments
+        await job_assignments_collection.delete_one({"_id": assignment["_id"]})
+        return "Not found"
+    # a newer report of the sensor marks the assignment again
+    await job_assignments_collection.update_one(
+        {"_id": assignment["_id"], "reported": reported, "counted": False}, {"$set": {"counted": True}})
+
+    fix_job = update_job["name"]
+    state_counts = {state: update_job["state_counts"].get(state, 0) + change for state, change in state_changes.items()}
+    job_status = job_status_of(state_counts, update_job["status"])
+    print("job {}: sensor {} is {}, job is {}".format(fix_job, sensor, status, job_status))
+
+    if job_status != update_job["status"] and job_status == "running":
+        # pull job from job lists once it's running
+        await job_assignments_collection.update_many(
+            {"job_id": update_job["_id"], "listed": True},
+            {"$set": {"listed": False, "updated": datetime.now(timezone.utc)}})
+    if job_status != update_job["status"] or assignment["state"] != status:
+        # every job list with this job shows its status and the states of all its sensors, so all of them changed
+        await increase_job_versions(await fixed_job_sensor_names({"_id": update_job["_id"]}))
+    return True
 
-    # change status depending on new states
-    updated_job = await fixed_jobs_collection.find_one({"_id": ObjectId(job_id)})
-    sensor_states = updated_job["states"]
-
-    # if at least one state is failed -> failed
-    # if all states are finished -> finished
-    # otherwise if at least one state is running -> running
-    failed = False
-    finished = True
-    running = False
-    for key, value in sensor_states.items():
-        if value.startswith("failed"):
-            failed = True
-        if not value.startswith("finished"):
-            finished = False
-        if value.startswith("running"):
-            running = True
-    print("failed: {}, finished: {}, running: {}".format(failed, finished, running))
-    fix_job = updated_job["name"]
-    if failed:
-        await set_status(fix_job, "failed")
-    elif finished:
-        await set_status(fix_job, "finished")
-    elif running:
-        await set_status(fix_job, "running")
-        await sensors_collection.update_many({},
-                                             {"$pull": {"jobs": fix_job}})  # pull job from job lists once it's running
-    # else it stays pending
 
-    # returns a document with matchedCount, modifiedCount, upsertedId, acknowledged. See MongoDB docs for updateOne().
-    return result
+# Count the states of the fixed jobs again whose counters missed a state change, because a state report stopped
+# between its two updates. Assignments that were reported less than repair_after seconds ago belong to reports that
+# may still be running. The counters are only replaced if no report changed them while they were counted.
+# Returns the number of repaired jobs.
+async def repair_fixed_job_state_counts(repair_after: float) -> int:
+    stale = datetime.now(timezone.utc) - timedelta(seconds=repair_after)
+    job_ids = await job_assignments_collection.distinct("job_id", {"counted": False, "reported": {"$lt": stale}})
+    repaired = 0
+    for job_id in job_ids:
+        fixed_job = await fixed_jobs_collection.find_one({"_id": job_id}, {"state_counts": 1, "status": 1})
+        if not fixed_job:
+            await job_assignments_collection.delete_many({"job_id": job_id})
+            continue
+        if await job_assignments_collection.find_one({"job_id": job_id, "counted": False, "reported": {"$gte": stale}},
+                                                     {"_id": 1}):
+            continue  # a report is running, the job is repaired next time
+        state_counts = dict.fromkeys(FIXED_JOB_STATES, 0)
+        pipeline = [
+            {"$match": {"job_id": job_id, "state": {"$ne": None}}},
+            {"$group": {"_id": job_state_expression("$state"), "count": {"$sum": 1}}},
+        ]
+        async for count in job_assignments_collection.aggregate(pipeline):
+            state_counts[count["_id"]] = count["count"]
+        replaced = await fixed_jobs_collection.find_one_and_update(
+            {"_id": job_id, "state_counts": fixed_job.get("state_counts")},
+            [{"$set": {"state_counts": state_counts}},
+             {"$set": {"status": job_status_expression("$state_counts", "$status")}}],
+            projection={"status": 1}, return_document=pymongo.ReturnDocument.AFTER)
+        if replaced:
+            if replaced["status"] == "running" and fixed_job["status"] != "running":
+                # pull job from job lists once it's running, like set_sensor_status
+                await job_assignments_collection.update_many(
+                    {"job_id": job_id, "listed": True},
+                    {"$set": {"listed": False, "updated": datetime.now(timezone.utc)}})
+            await job_assignments_collection.update_many(
+                {"job_id": job_id, "counted": False, "reported": {"$lt": stale}}, {"$set": {"counted": True}})
+            await increase_job_versions(await fixed_job_sensor_names({"_id": job_id}))
+            repaired += 1
+    return repaired
 
 
 async def delete_fixed_job(name: str):
     # return and delete the document matching 'id'
     result = await fixed_jobs_collection.find_one_and_delete({"name": name})
-    # remove the pointer to this fixed job from all job lists
-    await sensors_collection.update_many({}, {"$pull": {"jobs": result["name"]}})
+    if not result:
+        return None
+    # remove the assignments of this fixed job, which also removes it from all job lists
+    sensor_names = await job_assignments_collection.distinct("sensor_name", {"job_id": result["_id"]})
+    await job_assignments_collection.delete_many({"job_id": result["_id"]})
+    await increase_job_versions(sensor_names)
     # returns either the deleted document, or null if no document matched
     return result
 
 
 async def return_fixed_jobs():
-    fixed_jobs = []
     # returns a cursor to all documents in the collection
     fixed_jobs_cursor = fixed_jobs_collection.find().sort("start_time", pymongo.DESCENDING)
     # iterate the cursor and return all documents in a list, parameter length determines max length of the list
-    for fixed_job in await fixed_jobs_cursor.to_list(length=None):
-        fixed_jobs.append(fixed_jobs_helper(fixed_job))
-    return fixed_jobs
+    return await fixed_jobs_with_assignments(await fixed_jobs_cursor.to_list(length=None))
 
 
 async def return_pending_fixed_jobs_by_sensorname(sensor_name: str):
     sensor_name = str(sensor_name)
     if not uses_allowed_characters(sensor_name):
         return "invalid input"
-    fixed_jobs = []
+    job_ids = await job_assignments_collection.distinct("job_id", {"sensor_name": sensor_name})
     # returns a cursor to all documents in the collection
     fixed_jobs_cursor = fixed_jobs_collection.find(
-        {"sensors": sensor_name, "status": {"$in": ["pending"]}}).sort("start_time", pymongo.ASCENDING)
+        {"_id": {"$in": job_ids}, "status": {"$in": ["pending"]}}).sort("start_time", pymongo.ASCENDING)
     # iterate the cursor and return all documents in a list, parameter length determines max length of the list
-    for fixed_job in await fixed_jobs_cursor.to_list(length=None):
-        fixed_jobs.append(fixed_jobs_helper(fixed_job))
-    return fixed_jobs
-
+    return await fixed_jobs_with_assignments(await fixed_jobs_cursor.to_list(length=None))
 
 
-async def return_fixed_job_by_job_id(job_id: str):
+# with_assignments=False leaves out the sensors and states of the job, for callers that don't need them
+async def return_fixed_job_by_job_id(job_id: str, with_assignments: bool = True):
     job = await fixed_jobs_collection.find_one({"_id": ObjectId(job_id)})
     if job:
-        return fixed_jobs_helper(job)
+        if not with_assignments:
+            return fixed_jobs_helper(job, [])
+        return (await fixed_jobs_with_assignments([job]))[0]
+
+# -----------------------------------------
+# ----------- JOB VERSION METHODS ---------
+# -----------------------------------------
+# Every change of the pending job list of a sensor increases its version. The versions come from one counter in
+# versions_collection, a change that affects all sensors is stored as version of "all". Every worker keeps the
+# versions in job_versions and refreshes them regularly, the version of a sensor is the larger of both.
+
+# names of the sensors assigned to the matching fixed jobs
+async def fixed_job_sensor_names(query: dict) -> list:
+    job_ids = await fixed_jobs_collection.distinct("_id", query)
+    return await job_assignments_collection.distinct("sensor_name", {"job_id": {"$in": job_ids}})
+
+
+# Increase the job list version of the given sensors, of all sensors if sensor_names is None
+async def increase_job_versions(sensor_names: list = None):
+    counter = await versions_collection.find_one_and_update(
+        {"_id": "fixed_jobs"}, {"$inc": {"version": 1}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    version = counter["version"]
+    if sensor_names is None:
+        await versions_collection.update_one({"_id": "fixed_jobs_all"}, {"$max": {"version": version}}, upsert=True)
+        job_versions["all"] = max(job_versions["all"], version)
+        notify_job_versions()
+        return
+    if not sensor_names:
+        return
+    updated = datetime.now(timezone.utc)
+    await job_versions_collection.bulk_write(
+        [pymongo.UpdateOne({"_id": name}, {"$max": {"version": version}, "$set": {"updated": updated}}, upsert=True)
+         for name in sensor_names], ordered=False)
+    for name in sensor_names:
+        job_versions["sensors"][name] = max(job_versions["sensors"].get(name, 0), version)
+    notify_job_versions(sensor_names)
+
+
+# Load the versions that changed since the last refresh (all of them on the first call)
+async def refresh_job_versions():
+    started = datetime.now(timezone.utc)
+    query = {}
+    if job_versions["refreshed"] is not None:
+        # versions are written after the counter was increased, a little overlap catches late writes
+        query = {"updated": {"$gte": job_versions["refreshed"] - timedelta(seconds=JOB_VERSION_REFRESH_OVERLAP)}}
+    changed = []
+    async for version in job_versions_collection.find(query):
+        if version["version"] > job_versions["sensors"].get(version["_id"], 0):
+            job_versions["sensors"][version["_id"]] = version["version"]
+            changed.append(version["_id"])
+    notify_job_versions(changed)
+    version_all = await versions_collection.find_one({"_id": "fixed_jobs_all"})
+    if version_all and version_all["version"] > job_versions["all"]:
+        job_versions["all"] = version_all["version"]
+        notify_job_versions()
+    job_versions["refreshed"] = started
+    job_versions["loaded"] = True
+
+
+# Wake up the job streams of the given sensors, of all sensors if sensor_names is None
+def notify_job_versions(sensor_names: list = None):
+    if sensor_names is None:
+        sensor_names = list(job_version_events.keys())
+    for name in sensor_names:
+        event = job_version_events.pop(name, None)
+        if event is not None:
+            event.set()
+
+
+# Wait until the job list version of a sensor differs from version, at most timeout seconds.
+# Returns the current version (None until the versions were loaded).
+async def wait_for_job_version(sensor_name: str, version: int, timeout: float):
+    current = retrieve_job_version(sensor_name)
+    if current is not None and current != version:
+        return current
+    event = job_version_events.setdefault(sensor_name, asyncio.Event())
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return retrieve_job_version(sensor_name)
+
+
+# Version of the pending job list of a sensor from memory, None until the versions were loaded
+def retrieve_job_version(sensor_name: str):
+    if not job_versions["loaded"]:
+        return None
+    return max(job_versions["sensors"].get(sensor_name, 0), job_versions["all"])
 
 
 # -----------------------------------------
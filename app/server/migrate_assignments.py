@@ -0,0 +1,72 @@
+# This file moves the assignments of sensors to fixed jobs into the job_assignments collection:
+# - the sensors and states of every fixed job ("sensors", "states") become one assignment per sensor
+# - the job list of every sensor ("jobs") marks the assignments of the listed jobs
+# - the indexes on the old fields are dropped
+#
+# Run it from the root directory after the update, before the sensors poll their jobs again:
+# (env)$ `python -m app.server.migrate_assignments`
+# The fixed jobs are migrated before the sensors, because a job list can only mark assignments that exist. Every
+# document loses its old fields only after its assignments are written, an interrupted migration is resumed by
+# running it again.
+
+import asyncio
+
+import pymongo.errors
+
+from app.server.database import (
+    ensure_indexes,
+    fixed_jobs_collection,
+    sensors_collection,
+    iterate_unmigrated_fixed_jobs,
+    migrate_fixed_job_assignments,
+    iterate_unmigrated_sensors,
+    migrate_sensor_job_list,
+    increase_job_versions,
+)
+
+OBSOLETE_INDEXES = [(fixed_jobs_collection, "sensors_1_status_1_start_time_1"), (sensors_collection, "jobs_1")]
+
+
+async def migrate_fixed_jobs() -> (int, int):
+    jobs, assignments = 0, 0
+    async for fixed_job in iterate_unmigrated_fixed_jobs():
+        assignments += await migrate_fixed_job_assignments(fixed_job)
+        jobs += 1
+        if jobs % 100 == 0:
+            print(f"migrate_assignments: {jobs} fixed jobs migrated")
+    return jobs, assignments
+
+
+async def migrate_sensors() -> (int, int, int):
+    sensors, listed, dropped = 0, 0, 0
+    async for sensor in iterate_unmigrated_sensors():
+        sensor_listed, sensor_dropped = await migrate_sensor_job_list(sensor)
+        if sensor_dropped:
+            print(f"migrate_assignments: {sensor_dropped} jobs in the job list of {sensor['sensor_name']} "
+                  f"are not assigned to it, dropped")
+        sensors += 1
+        listed += sensor_listed
+        dropped += sensor_dropped
+    return sensors, listed, dropped
+
+
+async def drop_obsolete_indexes():
+    for collection, index_name in OBSOLETE_INDEXES:
+        try:
+            await collection.drop_index(index_name)
+        except pymongo.errors.OperationFailure:
+            pass  # dropped already
+
+
+async def main():
+    await ensure_indexes()  # the unique index prevents duplicate assignments
+    jobs, assignments = await migrate_fixed_jobs()
+    sensors, listed, dropped = await migrate_sensors()
+    await drop_obsolete_indexes()
+    await increase_job_versions()  # sensors that polled during the migration get their job lists again
+    print(f"migrate_assignments: done, {jobs} fixed jobs with {assignments} assignments and {sensors} sensors with "
+          f"{listed} listed jobs migrated, {dropped} job list entries dropped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
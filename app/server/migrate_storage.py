@@ -0,0 +1,106 @@
+# This file moves the files of app/server/file_uploads/ into the content-addressed layout of storage.py:
+# - files of uploads before the content-addressed storage (<file_name>_<id>) become blobs/<aa>/<bb>/<sha256>
+# - blobs that were stored without subfolders (blobs/<sha256>) are moved to their subfolders
+#
+# Run it from the root directory while the server is running: (env)$ `python -m app.server.migrate_storage`
+# Every file is linked to its new place before its data entry is switched to it and only unlinked afterwards, so
+# downloads keep working during the migration. An interrupted migration is resumed by running it again.
+
+import asyncio
+import hashlib
+import os
+
+from app.server.storage import upload_folder, blob_folder, blob_path, legacy_data_path
+from app.server.database import (
+    iterate_legacy_data,
+    set_data_blob,
+    reference_blob,
+    release_blob,
+    forget_blob,
+)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_sha256_hash(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        block = f.read(HASH_BLOCK_SIZE)
+        while block:
+            file_hash.update(block)
+            block = f.read(HASH_BLOCK_SIZE)
+    return file_hash.hexdigest()
+
+
+def link_file(source: str, destination: str):
+    # hard link source to destination without copying the data, an existing destination has the same content
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        pass
+
+
+def move_unsharded_blobs() -> int:
+    moved = 0
+    if not os.path.isdir(blob_folder):
+        return moved
+    with os.scandir(blob_folder) as entries:
+        for entry in entries:
+            if entry.is_file() and len(entry.name) == 64:  # uncompressed, codecs came with the subfolders
+                target = blob_path(entry.name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(entry.path, target)
+                moved += 1
+    return moved
+
+
+async def migrate_legacy_data() -> (int, int):
+    migrated, missing = 0, 0
+    async for data in iterate_legacy_data():
+        legacy_path = legacy_data_path(data["file_name"], data["id"])
+        if not os.path.isfile(legacy_path):
+            print(f"migrate_storage: file of data {data['id']} ({data['file_name']}) is missing, skipped")
+            missing += 1
+            continue
+        content_hash = data["content_hash"] or await asyncio.to_thread(file_sha256_hash, legacy_path)
+
+        # (1) reference the blob, (2) link the file to the blob unless it is stored already, (3) switch the data
+        # entry to the blob, (4) unlink the file. If the migration stops between (1) and (3), the blob keeps one
+        # reference too many and is never deleted, which wastes space but can't lose a file.
+        blob = await reference_blob(content_hash, os.path.getsize(legacy_path))
+        target = blob_path(content_hash, blob["codec"])
+        if not os.path.isfile(target):
+            try:
+                if blob["codec"] is not None:
+                    raise FileNotFoundError(target)  # the compressed file of the blob got lost
+                link_file(legacy_path, target)
+            except FileNotFoundError:
+                print(f"migrate_storage: could not link data {data['id']} ({data['file_name']}), skipped")
+                if await release_blob(content_hash):
+                    await forget_blob(content_hash)
+                continue
+        if not await set_data_blob(data["id"], content_hash, blob["codec"]):
+            # the data was deleted in the meantime
+            if await release_blob(content_hash):
+                if os.path.exists(target):
+                    os.unlink(target)
+                await forget_blob(content_hash)
+            continue
+        if os.path.exists(legacy_path):
+            os.unlink(legacy_path)
+        migrated += 1
+        if migrated % 1000 == 0:
+            print(f"migrate_storage: {migrated} files migrated")
+    return migrated, missing
+
+
+async def main():
+    print(f"migrate_storage: migrating {upload_folder}")
+    moved = move_unsharded_blobs()
+    migrated, missing = await migrate_legacy_data()
+    print(f"migrate_storage: done, {migrated} files migrated, {moved} blobs moved to subfolders, {missing} files missing")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
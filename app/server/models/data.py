@@ -1,4 +1,39 @@
 from fastapi import HTTPException
+from pydantic import BaseSettings
+
+
+class StorageSettings(BaseSettings):
+    # seconds without a new chunk after which an upload session and its chunks are deleted
+    upload_session_idle_timeout = 24 * 60 * 60  # 24h
+    # seconds between two runs of the reaper that deletes idle upload sessions
+    upload_reaper_interval = 10 * 60  # 10 minutes
+    # bytes a sensor may use for stored files and running uploads together, 0 means unlimited
+    sensor_storage_quota = 0
+    # codec that new files are compressed with: "" (stored as sent), "gzip" or "zstd" (needs the zstandard package)
+    storage_codec = ""
+    # compression level of the codec, 0 means its default
+    storage_compression_level = 0
+    # threads for blocking file system calls, at most this many requests wait for the disk at the same time
+    storage_io_threads = 8
+
+    class Config:
+        env_file = "env/.env"
+
+
+class UploadAdmissionSettings(BaseSettings):
+    # uploads to the /data routes that may run at the same time, in total and per sensor (0 means unlimited).
+    # All limits apply per worker process, uploads without a valid access token share the budget of one sensor.
+    max_concurrent_uploads = 32
+    max_concurrent_uploads_per_sensor = 4
+    # bytes (Content-Length) of the uploads that may be received at the same time, in total and per sensor
+    max_upload_bytes_in_flight = 4 * 1024 * 1024 * 1024  # 4 GiB
+    max_upload_bytes_in_flight_per_sensor = 1024 * 1024 * 1024  # 1 GiB
+    # bounds of the Retry-After (seconds) sent with a rejected upload
+    min_retry_after = 1
+    max_retry_after = 300
+
+    class Config:
+        env_file = "env/.env"
 
 
 def ResponseModel(data, message):
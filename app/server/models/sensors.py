@@ -1,7 +1,25 @@
 from typing import Optional, List
 from fastapi import HTTPException
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, BaseSettings, Field
+
+
+class SensorStatusSettings(BaseSettings):
+    # milliseconds between two writes of the buffered sensor status updates to the db
+    status_flush_interval_ms = 1000
+    # the buffered status updates are written right away when this many heartbeats are waiting
+    status_flush_max_entries = 500
+    # days the heartbeats are kept in the status history, 0 = forever. Only applies when the collection is created.
+    status_history_retention_days = 365
+    # seconds after the last contact ("status_time") until a sensor is shown offline on the map
+    sensor_offline_after = 24 * 3600
+    # seconds between two checks for sensors that went offline
+    location_refresh_interval = 60
+    # seconds a worker reuses the fleet summary before it is computed again
+    summary_cache_seconds = 5
+
+    class Config:
+        env_file = "env/.env"
 
 
 # Defines the pydantic schema for sensor lists which represents what data a request expects.
@@ -70,6 +88,27 @@ class UpdateAllSensorsModel(BaseModel):
         }
 
 
+class JobStateUpdateModel(BaseModel):
+    job_id: str
+    status: str
+
+
+class SensorSyncModel(BaseModel):
+    status: Optional[UpdateSensorStatusModel]
+    job_states: List[JobStateUpdateModel] = []
+    # version of the job list the sensor has, the jobs are only sent again if they changed
+    jobs_version: Optional[int]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "status": UpdateSensorStatusModel.Config.schema_extra["example"],
+                "job_states": [{"job_id": "62e2a0e5b4ed1a3a9a6e3c11", "status": "finished"}],
+                "jobs_version": 42
+            }
+        }
+
+
 # can return data like inserted id or a job list
 def ResponseModel(data, message):
     return {
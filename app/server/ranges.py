@@ -0,0 +1,203 @@
+# This file serves stored files with support for conditional and partial requests (RFC 7232 and RFC 7233):
+# ETag / If-None-Match, Last-Modified / If-Modified-Since, Range (single and multiple ranges) and If-Range.
+# Clients can resume an interrupted download or fetch several parts of a file in parallel.
+# Compressed files are sent as they are stored if the client accepts their encoding, otherwise they are decompressed
+# while they are sent. Files of chunked uploads consist of one compressed frame per chunk: zstd decoders read all
+# frames, but many HTTP clients only decode the first member of a gzip file, so gzip files are always decompressed.
+
+import secrets
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from app.server.storage import read_stored_file, file_stat
+
+MAX_RANGES = 32  # requests with more (non-overlapping) ranges get the whole file instead
+PASS_THROUGH_CODECS = ["zstd"]  # codecs whose files are sent as stored to clients that accept them
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(range_header: str, size: int):
+    # returns a sorted list of (first_byte, last_byte) tuples with overlapping and adjacent ranges merged,
+    # or None if the header is not a valid byte range and has to be ignored.
+    # Raises RangeNotSatisfiable if none of the ranges lies within the file.
+    unit, _, range_set = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not range_set:
+        return None
+    ranges = []
+    for range_spec in range_set.split(","):
+        first, separator, last = range_spec.strip().partition("-")
+        if not separator or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":  # suffix range: the last n bytes
+            if last == "":
+                return None
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+        else:
+            start = int(first)
+            end = size - 1 if last == "" else min(int(last), size - 1)
+            if last != "" and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            ranges.append((start, end))
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_etag(content_hash: str, size: int, mtime: float, content_encoding: str = None) -> str:
+    # strong ETag from the stored content hash, weak ETag for files uploaded before hashes were stored.
+    # The compressed representation of a file needs an ETag of its own.
+    if content_hash:
+        return '"' + content_hash + ('-' + content_encoding if content_encoding else '') + '"'
+    return 'W/"{:x}-{:x}"'.format(size, int(mtime))
+
+
+def accepts_encoding(accept_encoding: str, content_coding: str) -> bool:
+    # True if the Accept-Encoding header lists the content-coding (or *) without q=0
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in (content_coding, "*"):
+            continue
+        quality = params.strip().lower()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def _etag_in_list(etag: str, etag_list: str, weak_comparison: bool) -> bool:
+    if etag_list.strip() == "*":
+        return True
+    for candidate in etag_list.split(","):
+        candidate = candidate.strip()
+        if weak_comparison:
+            if candidate.removeprefix("W/") == etag.removeprefix("W/"):
+                return True
+        elif candidate == etag and not etag.startswith("W/"):
+            return True
+    return False
+
+
+def _not_modified_since(header_value: str, mtime: float) -> bool:
+    try:
+        return int(mtime) <= parsedate_to_datetime(header_value).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def _if_range_matches(if_range: str, etag: str, last_modified: str) -> bool:
+    # an ETag in If-Range needs a strong match, a date has to be exactly the Last-Modified date
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return _etag_in_list(etag, if_range, weak_comparison=False)
+    return if_range == last_modified
+
+
+async def _read_multipart_ranges(filepath: str, codec: str, ranges, part_headers, boundary: str):
+    for (start, end), part_header in zip(ranges, part_headers):
+        yield part_header
+        async for block in read_stored_file(filepath, codec, start, end):
+            yield block
+        yield b"\r\n"
+    yield ("--" + boundary + "--\r\n").encode()
+
+
+def _content_disposition(filename: str) -> str:
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return "attachment; filename*=utf-8''{}".format(quoted_filename)
+    return 'attachment; filename="{}"'.format(filename)
+
+
+async def file_range_response(request: Request, filepath: str, filename: str, content_hash: str = None,
+                              media_type: str = "application/octet-stream", codec: str = None,
+                              size: int = None) -> Response:
+    # codec: compression of the stored file, size: size of the file after decompression
+    stat_result = await file_stat(filepath)
+    content_encoding = None
+    if codec is None or (codec in PASS_THROUGH_CODECS and
+                         accepts_encoding(request.headers.get("accept-encoding"), codec)):
+        content_encoding = codec
+        size = stat_result.st_size
+        codec = None  # the file is sent as stored, ranges refer to the compressed bytes
+    etag = file_etag(content_hash, size, stat_result.st_mtime, content_encoding)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": _content_disposition(filename),
+    }
+    if content_encoding is not None or codec is not None:
+        headers["Vary"] = "Accept-Encoding"
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+
+    # conditional GET: the client already has this version of the file
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_in_list(etag, if_none_match, weak_comparison=True):
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since") is not None:
+        if _not_modified_since(request.headers["if-modified-since"], stat_result.st_mtime):
+            return Response(status_code=304, headers=headers)
+
+    ranges = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or _if_range_matches(if_range, etag, last_modified)):
+        try:
+            ranges = parse_range_header(range_header, size)
+        except RangeNotSatisfiable:
+            headers["Content-Range"] = "bytes */{}".format(size)
+            return Response(status_code=416, headers=headers)
+        if ranges is not None and len(ranges) > MAX_RANGES:
+            ranges = None
+
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(read_stored_file(filepath, codec, 0, size - 1), media_type=media_type,
+                                 headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(read_stored_file(filepath, codec, start, end), status_code=206,
+                                 media_type=media_type, headers=headers)
+
+    # several ranges are sent as multipart/byteranges, every part with its own Content-Range
+    boundary = secrets.token_hex(16)
+    part_headers = []
+    for start, end in ranges:
+        part_headers.append("--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n".format(
+            boundary, media_type, start, end, size).encode())
+    content_length = sum(len(part_header) + end - start + 1 + 2
+                         for part_header, (start, end) in zip(part_headers, ranges))
+    content_length += len(boundary) + 6
+    headers["Content-Length"] = str(content_length)
+    return StreamingResponse(_read_multipart_ranges(filepath, codec, ranges, part_headers, boundary), status_code=206,
+                             media_type="multipart/byteranges; boundary=" + boundary, headers=headers)
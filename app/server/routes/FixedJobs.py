@@ -1,7 +1,11 @@
-from fastapi import APIRouter, Body, Depends, HTTPException, status
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, Body, Depends, HTTPException, Request, Response, WebSocket, status
+from starlette.websockets import WebSocketDisconnect
 from fastapi.encoders import jsonable_encoder
 from fastapi_another_jwt_auth import AuthJWT
-from app.server.routes.login import validate_access_token_rights
+from app.server.routes.login import validate_access_token_rights, validate_websocket_token_rights
 import time
 
 
@@ -16,6 +20,10 @@ from app.server.database import (
     set_sensor_status,
     return_user_role,
     check_sensorName_exists,
+    refresh_job_versions,
+    retrieve_job_version,
+    wait_for_job_version,
+    repair_fixed_job_state_counts,
 )
 from app.server.models.FixedJobs import (
     FixedJobsSchema,
@@ -25,6 +33,35 @@ from app.server.models.FixedJobs import (
 
 router = APIRouter()
 
+JOB_VERSION_REFRESH_INTERVAL = 1  # seconds until the job list changes made by other workers are seen
+MAX_LONG_POLL_TIMEOUT = 60  # seconds a long-poll of the job stream waits at most
+WEBSOCKET_RECHECK_INTERVAL = 60  # seconds after which an idle job stream checks its token again
+JOB_STATE_REPAIR_INTERVAL = 60  # seconds between two looks for state reports that weren't counted
+JOB_STATE_REPAIR_AFTER = 60  # seconds after which a state report that wasn't counted is considered failed
+
+
+async def run_job_version_refresher():
+    # background task started with the app: loads the job list versions changed by other workers
+    while True:
+        try:
+            await refresh_job_versions()
+        except Exception as ex:
+            print(f"run_job_version_refresher: {ex}")
+        await asyncio.sleep(JOB_VERSION_REFRESH_INTERVAL)
+
+
+async def run_job_state_repairer():
+    # background task started with the app: counts the states of fixed jobs again whose counters missed a state
+    # change, e.g. because the server stopped in the middle of a state report
+    while True:
+        await asyncio.sleep(JOB_STATE_REPAIR_INTERVAL)
+        try:
+            repaired = await repair_fixed_job_state_counts(JOB_STATE_REPAIR_AFTER)
+            if repaired:
+                print(f"run_job_state_repairer: state counters of {repaired} fixed jobs repaired")
+        except Exception as ex:
+            print(f"run_job_state_repairer: {ex}")
+
 
 @router.get("/", response_description="Returned fixed jobs")
 async def get_fixed_jobs(_Authorize: AuthJWT=Depends()):
@@ -39,18 +76,122 @@ async def get_fixed_jobs(_Authorize: AuthJWT=Depends()):
 
 
 @router.get("/{name}", response_description="Return all pending and running jobs for a given sensor_name")
-async def get_fixed_jobs_by_sensorname(name: str,  _Authorize: AuthJWT=Depends()):
+async def get_fixed_jobs_by_sensorname(name: str, request: Request, response: Response,  _Authorize: AuthJWT=Depends()):
     #TODO: rename the router-path to "/sensor_name/{name}" for clarification. But this also needs to be adjusted in the sensors!
     #permissions: admin, user, sensor
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
         return ErrorResponseModel(401, "Unauthorized.")
 
+    # polls with the ETag of the current job list are answered from memory. The version is taken before the list
+    # is read, a change in between only causes one more full answer.
+    version = retrieve_job_version(name)
+    if version is not None:
+        etag = '"' + str(version) + '"'
+        if request.headers.get("if-none-match") in (etag, "W/" + etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+
     fixed_jobs = await return_pending_fixed_jobs_by_sensorname(name)
     if fixed_jobs is not None:
         return ResponseModel(fixed_jobs, "Retrieved fixed jobs")
     return ErrorResponseModel(500, "Could not retrieve fixed jobs")
 
 
+def job_stream_message(version: int, fixed_jobs: list, known_jobs: list = None) -> dict:
+    # message of the job stream: the pending jobs of the sensor and, if the jobs the sensor knows are given,
+    # the names of the jobs that were added and removed since then
+    message = {"version": version, "jobs": fixed_jobs}
+    if known_jobs is not None:
+        job_names = [job["name"] for job in fixed_jobs]
+        known_job_names = [job["name"] for job in known_jobs]
+        message["added"] = [name for name in job_names if name not in known_job_names]
+        message["removed"] = [name for name in known_job_names if name not in job_names]
+    return message
+
+
+@router.websocket("/stream/{sensor_name}")
+async def stream_fixed_jobs(websocket: WebSocket, sensor_name: str):
+    # opt-in push channel for the pending jobs of a sensor: sends the job list when the stream is opened and again
+    # as soon as it changes, with the names of the added and removed jobs. The access token is sent in the
+    # Authorization header of the handshake or, if the client can't set headers, as query parameter "token".
+    #permissions: admin, sensor (a sensor only gets its own jobs)
+    token = websocket.query_params.get("token")
+    authorization = websocket.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if not token or not await validate_websocket_token_rights(token, required_permissions=["admin", "sensor"]) or \
+            not job_stream_allowed(token, sensor_name):
+        await websocket.close(code=1008)  # policy violation
+        return
+    await websocket.accept()
+
+    # the client doesn't send anything, but its messages have to be read to notice when it goes away
+    receiver = asyncio.create_task(websocket.receive())
+    waiter = None
+    try:
+        version = retrieve_job_version(sensor_name)
+        known_jobs = []
+        while True:
+            fixed_jobs = await return_pending_fixed_jobs_by_sensorname(sensor_name)
+            await websocket.send_json(job_stream_message(version, fixed_jobs, known_jobs))
+            known_jobs = fixed_jobs
+            while True:
+                waiter = asyncio.create_task(wait_for_job_version(sensor_name, version, WEBSOCKET_RECHECK_INTERVAL))
+                done, _ = await asyncio.wait({receiver, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                if receiver in done:
+                    if receiver.result()["type"] == "websocket.disconnect":
+                        return
+                    receiver = asyncio.create_task(websocket.receive())
+                if waiter in done:
+                    new_version = waiter.result()
+                    if new_version != version:
+                        version = new_version
+                        break
+                    if not await validate_websocket_token_rights(token, required_permissions=["admin", "sensor"]):
+                        await websocket.close(code=1008)
+                        return
+                else:
+                    waiter.cancel()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        if waiter is not None:
+            waiter.cancel()
+
+
+@router.get("/stream/{sensor_name}", response_description="Return the pending jobs of a sensor once they change")
+async def long_poll_fixed_jobs(sensor_name: str, version: Optional[int] = None, timeout: int = 30,
+                               _Authorize: AuthJWT=Depends()):
+    # long-poll fallback of the job stream for networks that don't allow WebSockets: waits up to timeout seconds
+    # until the version of the job list of the sensor differs from version (the version of the last answer),
+    # returns 304 if it didn't change. Without version the job list is returned right away.
+    #permissions: admin, sensor (a sensor only gets its own jobs)
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["admin", "sensor"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+    if not job_stream_allowed(None, sensor_name, _Authorize):
+        return ErrorResponseModel(403, "Insufficient rights.")
+    if not 0 <= timeout <= MAX_LONG_POLL_TIMEOUT:
+        return ErrorResponseModel(400, "timeout has to be between 0 and " + str(MAX_LONG_POLL_TIMEOUT) + " seconds.")
+
+    current = retrieve_job_version(sensor_name)
+    if version is not None:
+        current = await wait_for_job_version(sensor_name, version, timeout)
+        if current == version:
+            return Response(status_code=304, headers={"ETag": '"' + str(current) + '"'})
+    fixed_jobs = await return_pending_fixed_jobs_by_sensorname(sensor_name)
+    return ResponseModel(job_stream_message(current, fixed_jobs), "Retrieved fixed jobs")
+
+
+def job_stream_allowed(token: str, sensor_name: str, _Authorize: AuthJWT = None) -> bool:
+    # sensors may only subscribe to their own jobs, the subject of a sensor token is the sensor name
+    raw_jwt = _Authorize.get_raw_jwt() if _Authorize is not None else AuthJWT().get_raw_jwt(token)
+    role = raw_jwt['role']
+    if type(role) == list:
+        role = role[0]
+    return role != "sensor" or raw_jwt['sub'] == sensor_name
+
+
 @router.get("/job_id/{job_id}", response_description="Return one specific job for a given job id")
 async def get_fixed_jobs_by_id(job_id: str,  _Authorize: AuthJWT=Depends()):
     #permissions: admin, user
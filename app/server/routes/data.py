@@ -5,97 +5,223 @@
 # JSON compatible
 
 import os
-import shutil
+import base64
 import hashlib  # for md5hashes of files
+import secrets
+import time
+import asyncio
+from functools import partial
 from fileinput import filename
 
-import aiofiles  # library for non-blocking write/read operations
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException, status
+from fastapi import APIRouter, UploadFile, File, Depends, Header, HTTPException, Request, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse
-from fastapi.background import BackgroundTasks
-from zipfile import ZipFile
-from os.path import basename
+from fastapi.responses import StreamingResponse
+from typing import Optional
 from fastapi_another_jwt_auth import AuthJWT
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from bson.objectid import ObjectId
 from app.server.routes.login import validate_access_token_rights
+from app.server.zip_stream import stream_zip
+from app.server.ranges import file_range_response
+from app.server.admission import upload_admission
+from app.server.storage import (
+    upload_folder,
+    blob_path,
+    data_file_path,
+    temp_path,
+    codec_available,
+    compressing_writer,
+    open_stored_file,
+    run_blocking,
+    remove_file,
+    remove_folder,
+    delete_file,
+    delete_folder,
+    is_file,
+    file_stat,
+    make_dirs,
+    move_file,
+    list_folder,
+)
 
 from app.server.database import (
     add_data,
     delete_data,
     delete_all_data_db,
     retrieve_data,
-    retrieve_all_data,
+    iterate_data,
+    data_fields,
     return_user_role,
     return_fixed_job_by_job_id,
+    open_upload_session,
+    retrieve_upload_session,
+    add_received_chunk,
+    claim_upload_session,
+    complete_upload_session,
+    discard_upload_session,
+    retrieve_idle_upload_session_ids,
+    delete_all_upload_sessions,
+    add_complete_upload_session,
+    reference_blob,
+    release_blob,
+    forget_blob,
+    replace_blob_codec,
+    retrieve_blob,
+    retrieve_storage_usage,
+    retrieve_all_storage_usage,
 )
 from app.server.models.data import (
     ErrorResponseModel,
     ResponseModel,
+    StorageSettings,
 )
 
 router = APIRouter()
-work_dir = os.getcwd()  # directory from which the script is executed, "sensor-management-system" is assumed
-
-
-# adds metadata to database and file to filesystem
+settings = StorageSettings()
+storage_codec = settings.storage_codec or None  # new files are compressed with this codec
+if storage_codec and not codec_available(storage_codec):
+    print(f"storage codec {storage_codec} is not available, files are stored uncompressed")
+    storage_codec = None
+COPY_BLOCK_SIZE = 1024 * 1024  # block size for copying chunks into the assembled file
+# sha256 of the assembled part of running chunk uploads: assembly-path -> (assembled size, hash object)
+assembly_hashes = {}
+# one lock per upload session, only one request at a time appends chunks to the assembly file
+assembly_locks = {}
+DEFAULT_PAGE_SIZE = 100  # sensor data entries per page
+MAX_PAGE_SIZE = 1000
+
+
+# adds metadata to database and file to filesystem.
+# The multipart body (file field "in_file") is parsed inside the route, so an upload over the storage quota is
+# rejected by its Content-Length before the body is received.
 @router.post("/{sensor_name}/{job_name}", response_description="Sensor data added into the database")
-async def add_sensor_data(sensor_name: str, job_name: str, in_file: UploadFile = File(...),  _Authorize: AuthJWT=Depends()):
+async def add_sensor_data(sensor_name: str, job_name: str, request: Request,  _Authorize: AuthJWT=Depends()):
     #permissions: admin, user, sensor
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
         return ErrorResponseModel(401, "Unauthorized.")
+    await check_storage_quota(sensor_name, request_content_length(request))
 
-        
-    print(in_file.content_type)
-    file_content = await in_file.read()
-    file_db = {"file_name": in_file.filename, "size": len(file_content)/1000.0, "file": in_file, "sensor_name": sensor_name, "job_name": job_name,}
-    file_db_json = jsonable_encoder(file_db)
-    new_file_db = await add_data(file_db_json)
+    form = await request.form()
+    try:
+        in_file = form.get("in_file")
+        if not isinstance(in_file, StarletteUploadFile):
+            return ErrorResponseModel(422, "The file is missing (form field in_file).")
+        print(in_file.content_type)
+        if not is_valid_file_name(in_file.filename):
+            return ErrorResponseModel(422, "Invalid file name.")
+
+        new_file_db = await store_sensor_data(sensor_name, job_name, in_file.filename,
+                                              partial(run_blocking, copy_and_hash, in_file.file))
+    finally:
+        await form.close()
+    return ResponseModel(new_file_db, "Sensor data added successfully.")
 
-    # save file to filesystem
-    file_id = new_file_db.get('id')
-    filepath = work_dir + '/app/server/file_uploads/' + in_file.filename + "_" + file_id
 
-    async with aiofiles.open(filepath, 'wb') as f:
-        await f.write(file_content)
+# same as add_sensor_data, but the body is the file itself (Content-Type: application/octet-stream) and the file name
+# is given as query parameter or X-File-Name header. The body is streamed to disk without multipart parsing.
+# If the sha256 of the file is sent in the X-Content-SHA256 header and the server already stores this content,
+# the body is not read and only the metadata is added.
+@router.post("/raw/{sensor_name}/{job_name}", response_description="Sensor data added into the database")
+async def add_sensor_data_raw(sensor_name: str, job_name: str, request: Request, file_name: Optional[str] = None,
+                              x_file_name: Optional[str] = Header(None), x_content_sha256: Optional[str] = Header(None),
+                              _Authorize: AuthJWT=Depends()):
+    #permissions: admin, user, sensor
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    file_name = file_name or x_file_name
+    if not file_name or not is_valid_file_name(file_name):
+        return ErrorResponseModel(422, "Invalid file name.")
+    await check_storage_quota(sensor_name, request_content_length(request, required=False))
 
+    if x_content_sha256:
+        new_file_db = await add_duplicate_data(sensor_name, job_name, file_name, x_content_sha256.lower())
+        if new_file_db:
+            return ResponseModel(new_file_db, "Sensor data added successfully, the content was already stored.")
+
+    new_file_db = await store_sensor_data(sensor_name, job_name, file_name,
+                                          partial(write_stream_and_hash, request.stream()))
     return ResponseModel(new_file_db, "Sensor data added successfully.")
 
 
-# just_metadata is an optional query parameter that omits the actual file by default
+# Returns the sensor data matching the optional filters, fields is a comma separated list of the fields to return.
+# With limit and/or cursor the data is returned in pages as {"items": [...], "next_cursor": ...}: the next page is
+# requested with the next_cursor of the previous one, which is None on the last page. Every page is read from an
+# index, no matter how much data is stored. Without them all data is returned as list.
 @router.get("/", response_description="Sensor data retrieved")
-async def get_all_sensor_data(_Authorize: AuthJWT=Depends()):
+async def get_all_sensor_data(sensor_name: Optional[str] = None, job_name: Optional[str] = None,
+                              start_time: Optional[int] = None, end_time: Optional[int] = None,
+                              fields: Optional[str] = None, limit: Optional[int] = None, cursor: Optional[str] = None,
+                              newest_first: bool = False, _Authorize: AuthJWT=Depends()):
     #permissions: admin, user, sensor
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
         return ErrorResponseModel(401, "Unauthorized.")
 
-    data = await retrieve_all_data()
-    if data:
-        return ResponseModel(data, "Sensor data retrieved successfully")
-    return ResponseModel(data, "Empty list returned")
-
-
-# zips all files in server/file_uploads/ for the download, deletes the zip after completion
+    field_list = None
+    if fields:
+        field_list = [field.strip() for field in fields.split(",") if field.strip() not in ("", "id")]
+        if not set(field_list) <= set(data_fields):
+            return ErrorResponseModel(422, "fields can contain: id, {0}.".format(", ".join(data_fields)))
+
+    if limit is None and cursor is None:
+        data = [data async for data in iterate_data(sensor_name, job_name, start_time, end_time, fields=field_list)]
+        if data:
+            return ResponseModel(data, "Sensor data retrieved successfully")
+        return ResponseModel(data, "Empty list returned")
+
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return ErrorResponseModel(422, "limit has to be between 1 and {0}.".format(MAX_PAGE_SIZE))
+    after_id = None
+    if cursor:
+        after_id, newest_first = decode_data_cursor(cursor)
+    # one more than the limit is read to know if there is a next page
+    items = [data async for data in iterate_data(sensor_name, job_name, start_time, end_time, after_id, newest_first,
+                                                 limit + 1, field_list)]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_data_cursor(items[-1]["id"], newest_first)
+    return ResponseModel({"items": items, "next_cursor": next_cursor}, "Sensor data retrieved successfully")
+
+
+# streams all files in server/file_uploads/ as a zip archive, optionally only the files matching the filters.
+# The archive is generated while it is sent, so neither memory nor disk usage grow with its size.
 @router.get("/download", response_description="Sensor data download successful")
-async def download_all(background_tasks: BackgroundTasks,  _Authorize: AuthJWT=Depends()):
+async def download_all(sensor_name: Optional[str] = None, job_name: Optional[str] = None,
+                       start_time: Optional[int] = None, end_time: Optional[int] = None,
+                       _Authorize: AuthJWT=Depends()):
     #permissions: admin, user 
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin"]):
         return ErrorResponseModel(401, "Unauthorized.")
-    return ErrorResponseModel(503, "Service Unavailable.")  # TODO: hotfix to pevent server crashes due to out-of-memory
-
-    with ZipFile('app/static/download.zip', 'w') as downloadZip:
-        # iterate over all saved files
-        for folderName, subfolder, filenames in os.walk('app/server/file_uploads/'):
-            for filename in filenames:
-                if filename == ".gitkeep":
-                    continue #don't add the gitkeep file
-                filepath = os.path.join(folderName, filename)
-                downloadZip.write(filepath, basename(filepath))
-    background_tasks.add_task(remove_file, 'app/static/download.zip')  # happens after completion
-    return FileResponse('app/static/download.zip', filename="download.zip")
+
+    entries = archive_entries(iterate_data(sensor_name, job_name, start_time, end_time))
+    return StreamingResponse(stream_zip(entries), media_type="application/zip",
+                             headers={"Content-Disposition": 'attachment; filename="download.zip"'})
+
+
+# streams all files of a fixed job as a zip archive with a folder per sensor, in the order they were uploaded
+@router.get("/job/{job_id}/archive", response_description="Sensor data download successful")
+async def download_job_archive(job_id: str, _Authorize: AuthJWT=Depends()):
+    #permissions: admin, user
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    if not ObjectId.is_valid(job_id):
+        return ErrorResponseModel(404, "Fixed job with id {0} doesn't exist".format(job_id))
+    job = await return_fixed_job_by_job_id(job_id, with_assignments=False)
+    if not job:
+        return ErrorResponseModel(404, "Fixed job with id {0} doesn't exist".format(job_id))
+
+    entries = archive_entries(iterate_data(job_name=job["name"]), sensor_folders=True)  # uses the job_name index
+    return StreamingResponse(stream_zip(entries), media_type="application/zip",
+                             headers={"Content-Disposition": 'attachment; filename="job_{0}.zip"'.format(job_id)})
+
 
 # download one specific file
 @router.get("/download/{id}", response_description="Sensor data download successful")
-async def download_single(id,  _Authorize: AuthJWT=Depends()):
+async def download_single(id, request: Request,  _Authorize: AuthJWT=Depends()):
     #permissions: admin, user
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin"]):
         return ErrorResponseModel(401, "Unauthorized.")
@@ -104,9 +230,11 @@ async def download_single(id,  _Authorize: AuthJWT=Depends()):
     data = await retrieve_data(id)
     if data:
         data_file = data["file_name"]
-        filepath = work_dir + '/app/server/file_uploads/' + data_file + "_" + id
-        if os.path.isfile(filepath):
-            return FileResponse(filepath, filename=data_file)
+        filepath = data_file_path(data)
+        if await is_file(filepath):
+            # supports Range/If-Range for resuming and parallel downloads, ETag/Last-Modified for caching
+            return await file_range_response(request, filepath, data_file, data["content_hash"],
+                                             codec=data["codec"], size=round(data["size"] * 1000))
         return ErrorResponseModel(404, "File with id {0} doesn't exist".format(id)
         )
     return ErrorResponseModel(404, "Sensor data with id {0} doesn't exist".format(id)
@@ -114,6 +242,27 @@ async def download_single(id,  _Authorize: AuthJWT=Depends()):
 
 
 
+# uploads that are being received right now, in total and per sensor, and the limits they are admitted with
+@router.get("/upload_occupancy", response_description="Upload occupancy retrieved")
+async def get_upload_occupancy(_Authorize: AuthJWT=Depends()):
+    #permissions: admin, user
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    return ResponseModel(upload_admission.occupancy(), "Upload occupancy retrieved successfully")
+
+
+# bytes used by each sensor for stored files and running uploads
+@router.get("/storage_usage", response_description="Storage usage retrieved")
+async def get_storage_usage(_Authorize: AuthJWT=Depends()):
+    #permissions: admin, user
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    usage = await retrieve_all_storage_usage()
+    return ResponseModel({"quota": settings.sensor_storage_quota, "sensors": usage}, "Storage usage retrieved successfully")
+
+
 @router.get("/{id}", response_description="Sensor data retrieved")
 async def get_sensor_data(id,  _Authorize: AuthJWT=Depends()):
     #permissions: admin, user
@@ -133,14 +282,12 @@ async def delete_all_sensor_data(_Authorize: AuthJWT=Depends()):
         return ErrorResponseModel(401, "Unauthorized.")
 
 
-    path = work_dir + '/app/server/file_uploads/'
     try:
-        shutil.rmtree(path)
-        os.mkdir(path)
-        open(path+".gitkeep", 'a').close()
+        await run_blocking(reset_upload_folder)  # includes the blobs
     except OSError as e:
         print("Error: %s - %s." % (e.filename, e.strerror))
 
+    await delete_all_upload_sessions()  # their chunks were deleted with the folder
     deleted = await delete_all_data_db()
     if deleted:
         return ResponseModel("Deletion successful.", "All files deleted.")
@@ -155,13 +302,17 @@ async def delete_sensor_data(id: str,  _Authorize: AuthJWT=Depends()):
         return ErrorResponseModel(401, "Unauthorized.")
 
         
+    if not ObjectId.is_valid(id):
+        return ErrorResponseModel(404, "Sensor data with id {0} doesn't exist".format(id))
     deleted_data = await delete_data(id)
 
-    filepath = work_dir + '/app/server/file_uploads/' + deleted_data + "_" + id
-    if os.path.isfile(filepath):
-        os.remove(filepath)
-
     if deleted_data:
+        # the file of a blob is only deleted with its last reference
+        if not deleted_data["blob"]:
+            await delete_file(data_file_path(deleted_data))
+        elif await release_blob(deleted_data["content_hash"]):
+            await delete_file(data_file_path(deleted_data))
+            await forget_blob(deleted_data["content_hash"])
         return ResponseModel(
             "Sensor data with ID: {} removed".format(id), "Sensor data deleted successfully"
         )
@@ -171,86 +322,497 @@ async def delete_sensor_data(id: str,  _Authorize: AuthJWT=Depends()):
 
 
 @router.post("/upload/{sensor_name}/{job_id}", response_description="Sensor data added into the database")
-async def upload_sensor_data_chunk(sensor_name: str, job_id: str, chunk_nr: int, chunks_remaining: int, chunk_md5: str, in_file: UploadFile = File(...),
-                          _Authorize: AuthJWT = Depends()):
+async def upload_sensor_data_chunk(sensor_name: str, job_id: str, chunk_nr: int, chunks_remaining: int, chunk_md5: str,
+                                   request: Request, _Authorize: AuthJWT = Depends()):
     # Hint: chunk_nr is supposed to start with 0!
+    # Chunks are stored in the upload session of the sensor for this job and file, which is created with the
+    # first chunk. The session API below allows to send chunks in any order and to ask for the missing ones.
+    # The chunk (file field "in_file") is parsed inside the route, so it is checked against the storage quota
+    # before its body is received.
     # permissions: admin, user, sensor
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
         return ErrorResponseModel(401, "Unauthorized.")
+    await check_storage_quota(sensor_name, request_content_length(request))
+
+    form = await request.form()
+    try:
+        in_file = form.get("in_file")
+        if not isinstance(in_file, StarletteUploadFile):
+            return ErrorResponseModel(422, "The file is missing (form field in_file).")
+        return await store_sensor_data_chunk(sensor_name, job_id, chunk_nr, chunks_remaining, chunk_md5, in_file)
+    finally:
+        await form.close()
 
-    # write the chunk to a chunk-file
-    file_content = await in_file.read()
+
+async def store_sensor_data_chunk(sensor_name: str, job_id: str, chunk_nr: int, chunks_remaining: int,
+                                  chunk_md5: str, in_file: StarletteUploadFile):
     if not in_file.filename.__contains__("_part" + str(chunk_nr)):
         return ErrorResponseModel(422, f"Filename has to end with '_part{chunk_nr}'.")
-    temp_folder = work_dir + '/app/server/file_uploads/' + 'tmp_' + job_id + '/'
+    raw_name = in_file.filename[:in_file.filename.rindex("_part")]
+    if not is_valid_file_name(raw_name):
+        return ErrorResponseModel(422, "Invalid file name.")
+    chunk_count = chunk_nr + chunks_remaining + 1
+    session = await open_upload_session(sensor_name, job_id, raw_name, chunk_count)
+    if session["chunk_count"] != chunk_count:
+        # the file is sent with a different chunking than before, start over
+        await discard_upload_session(session["id"])
+        await delete_folder(upload_session_folder(session["id"]))
+        session = await open_upload_session(sensor_name, job_id, raw_name, chunk_count)
+    if session["received_chunks"] == 0:
+        # new upload: the size of the file is estimated from the size of this chunk
+        await check_storage_quota(sensor_name, chunk_count * in_file.size if in_file.size else 0)
+
+    session, new_file_db = await store_upload_chunk(session, chunk_nr, chunk_md5,
+                                                    partial(run_blocking, copy_and_hash, in_file.file))
+    if new_file_db:
+        return ResponseModel(new_file_db, "Data uploaded successfully.")
+    if chunks_remaining > 0:
+        # wait for more chunks, sessions whose last chunk never arrives are deleted by the reaper
+        return ResponseModel(None, "Chunk uploaded.")
+    if not session["missing_chunks"]:
+        return ErrorResponseModel(409, "The file is being stored, check the upload session {0}.".format(session["id"]))
+    return ErrorResponseModel(416, f"Missing file-part: {raw_name}_part{session['missing_chunks'][0]}")
+
+
+# opens an upload session for a file that is sent in chunk_count chunks. An already open session of the sensor
+# for this job and file is returned instead, so an interrupted upload can be resumed with the missing chunks.
+# file_size is checked against the storage quota of the sensor before any chunk is sent.
+# If the sha256 of the file is sent as content_sha256 and the server already stores this content, the data entry is
+# added right away and the returned session is complete, no chunk has to be sent.
+@router.post("/upload_session/{sensor_name}/{job_id}", response_description="Upload session opened")
+async def create_upload_session(sensor_name: str, job_id: str, file_name: str, chunk_count: int,
+                                file_size: Optional[int] = None, content_sha256: Optional[str] = None,
+                                _Authorize: AuthJWT = Depends()):
+    # permissions: admin, user, sensor
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    if not is_valid_file_name(file_name):
+        return ErrorResponseModel(422, "Invalid file name.")
+    if chunk_count < 1:
+        return ErrorResponseModel(422, "chunk_count has to be at least 1.")
+    if not ObjectId.is_valid(job_id) or not await return_fixed_job_by_job_id(job_id, with_assignments=False):
+        return ErrorResponseModel(404, "Fixed job with id {0} doesn't exist".format(job_id))
+
+    if content_sha256:
+        job = await return_fixed_job_by_job_id(job_id, with_assignments=False)
+        new_file_db = await add_duplicate_data(sensor_name, job["name"], file_name, content_sha256.lower())
+        if new_file_db:
+            session = await add_complete_upload_session(sensor_name, job_id, file_name, chunk_count, new_file_db["id"])
+            return ResponseModel(session, "The content is already stored, upload session completed.")
+
+    session = await open_upload_session(sensor_name, job_id, file_name, chunk_count)
+    if session["received_chunks"] == 0 and file_size:
+        await check_storage_quota(sensor_name, file_size)
+    if session["chunk_count"] != chunk_count:
+        return ErrorResponseModel(409, "An upload session for this file with {0} chunks is already open.".format(
+            session["chunk_count"]))
+    return ResponseModel(session, "Upload session opened.")
+
+
+# returns the state of an upload session including the chunks that are still missing
+@router.get("/upload_session/{session_id}", response_description="Upload session retrieved")
+async def get_upload_session(session_id: str, _Authorize: AuthJWT = Depends()):
+    # permissions: admin, user, sensor
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    session = await retrieve_upload_session(session_id)
+    if session:
+        return ResponseModel(session, "Upload session retrieved successfully.")
+    return ErrorResponseModel(404, "Upload session with id {0} doesn't exist".format(session_id))
+
+
+# uploads one chunk of a session. Chunks can be sent in any order and in parallel, the file is stored as soon as
+# the last missing chunk arrived.
+@router.put("/upload_session/{session_id}/{chunk_nr}", response_description="Chunk uploaded")
+async def upload_session_chunk(session_id: str, chunk_nr: int, chunk_md5: str, in_file: UploadFile = File(...),
+                               _Authorize: AuthJWT = Depends()):
+    # permissions: admin, user, sensor
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    session = await retrieve_upload_session(session_id)
+    if not session:
+        return ErrorResponseModel(404, "Upload session with id {0} doesn't exist".format(session_id))
+    if not 0 <= chunk_nr < session["chunk_count"]:
+        return ErrorResponseModel(422, "chunk_nr has to be between 0 and {0}.".format(session["chunk_count"] - 1))
+
+    session, new_file_db = await store_upload_chunk(session, chunk_nr, chunk_md5,
+                                                    partial(run_blocking, copy_and_hash, in_file.file))
+    if new_file_db:
+        return ResponseModel(new_file_db, "Data uploaded successfully.")
+    return ResponseModel(session, "Chunk uploaded.")
+
+
+# same as upload_session_chunk, but the body is the chunk itself (Content-Type: application/octet-stream).
+# The body is streamed to disk without multipart parsing.
+@router.put("/upload_session/{session_id}/{chunk_nr}/raw", response_description="Chunk uploaded")
+async def upload_session_chunk_raw(session_id: str, chunk_nr: int, chunk_md5: str, request: Request,
+                                   _Authorize: AuthJWT = Depends()):
+    # permissions: admin, user, sensor
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin", "sensor"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+
+    session = await retrieve_upload_session(session_id)
+    if not session:
+        return ErrorResponseModel(404, "Upload session with id {0} doesn't exist".format(session_id))
+    if not 0 <= chunk_nr < session["chunk_count"]:
+        return ErrorResponseModel(422, "chunk_nr has to be between 0 and {0}.".format(session["chunk_count"] - 1))
+
+    session, new_file_db = await store_upload_chunk(session, chunk_nr, chunk_md5,
+                                                    partial(write_stream_and_hash, request.stream()))
+    if new_file_db:
+        return ResponseModel(new_file_db, "Data uploaded successfully.")
+    return ResponseModel(session, "Chunk uploaded.")
+
+
+# ---------------------------------------------------
+# ----------- server internal methods ---------------
+# ---------------------------------------------------
+
+def is_valid_file_name(file_name: str) -> bool:
+    # file names end up in paths on the server, so they must not contain a directory
+    return file_name not in ("", ".", "..") and os.path.basename(file_name) == file_name
+
+
+async def archive_entries(data_iterator, sensor_folders: bool = False):
+    # turns data entries into the entries of stream_zip, optionally in a folder per sensor
+    async for data in data_iterator:
+        arcname = data["file_name"] + "_" + data["id"]
+        if sensor_folders:
+            arcname = data["sensor_name"] + "/" + arcname
+        filepath = data_file_path(data)
+        try:
+            stat_result = await file_stat(filepath)
+        except FileNotFoundError:
+            continue  # skip entries whose file got lost
+        yield arcname, filepath, stat_result.st_mtime, data["codec"]
+
+
+def encode_data_cursor(last_id: str, newest_first: bool) -> str:
+    # the cursor is opaque for clients: the sort order and the id of the last entry of the page
+    return base64.urlsafe_b64encode(("d" if newest_first else "a").encode() + ObjectId(last_id).binary).decode()
+
+
+def decode_data_cursor(cursor: str) -> (str, bool):
+    # returns the id of the last entry of the previous page and the sort order
     try:
-        if not os.path.exists(temp_folder):
-            os.mkdir(temp_folder)
+        raw = base64.urlsafe_b64decode(cursor.encode())
+        if len(raw) != 13 or raw[:1] not in (b"a", b"d"):
+            raise ValueError(cursor)
+        return str(ObjectId(raw[1:])), raw[:1] == b"d"
+    except ValueError:
+        return ErrorResponseModel(422, "Invalid cursor.")
+
+
+def upload_session_folder(session_id: str) -> str:
+    return temp_path(session_id) + '/'
+
+
+def request_content_length(request: Request, required: bool = True) -> int:
+    # the Content-Length of a request, read before its body. Without the header the size is unknown, which is only
+    # accepted for streamed bodies (required=False) and counts as 0 bytes then.
+    content_length = request.headers.get("content-length")
+    if content_length is None:
+        if required:
+            return ErrorResponseModel(411, "Content-Length required.")
+        return 0
+    if not (content_length.isascii() and content_length.isdigit()):
+        return ErrorResponseModel(400, "Invalid Content-Length.")
+    return int(content_length)
+
+
+async def check_storage_quota(sensor_name: str, new_bytes: int):
+    # rejects an upload if the sensor would exceed its storage quota with new_bytes more
+    if settings.sensor_storage_quota <= 0:
+        return
+    usage = await retrieve_storage_usage(sensor_name)
+    if usage["temp_bytes"] + usage["stored_bytes"] + new_bytes > settings.sensor_storage_quota:
+        return ErrorResponseModel(507, "Storage quota of sensor {0} exceeded.".format(sensor_name))
+
+
+async def reap_upload_sessions():
+    # Deletes upload sessions (and their chunks) that did not receive a chunk within the idle timeout.
+    # Also removes temp folders without a session, e.g. of the 'tmp_<job_id>' folders of older versions, and
+    # temp files of single uploads that were interrupted.
+    idle_since = time.time() - settings.upload_session_idle_timeout
+    for session_id in await retrieve_idle_upload_session_ids(idle_since):
+        session = await discard_upload_session(session_id, idle_since)
+        if session:
+            if session["state"] != "complete":
+                print(f"reap_upload_sessions: discard session {session_id} of sensor {session['sensor_name']}")
+            await delete_folder(upload_session_folder(session_id))
+            assembly_locks.pop(session_id, None)
+
+    for name, path, is_folder, mtime in await list_folder(upload_folder):
+        if not name.startswith("tmp_") or mtime >= idle_since:
+            continue
+        if not is_folder:
+            print(f"reap_upload_sessions: remove orphaned file {name}")
+            await delete_file(path)
+        elif not await retrieve_upload_session(name[len("tmp_"):]):
+            print(f"reap_upload_sessions: remove orphaned folder {name}")
+            await delete_folder(path)
+
+
+async def run_upload_session_reaper():
+    # background task started with the app
+    while True:
+        try:
+            await reap_upload_sessions()
+        except Exception as ex:
+            print(f"run_upload_session_reaper: {ex}")
+        await asyncio.sleep(settings.upload_reaper_interval)
+
+
+async def store_sensor_data(sensor_name: str, job_name: str, file_name: str, write_file) -> dict:
+    # Stores an uploaded file and adds its metadata to the database, returns the new data entry.
+    # write_file(path, file_hash, codec) writes the received file compressed with codec to path, updates file_hash
+    # with the original content and returns its size.
+    # The file is written to a temp file first and becomes the blob of its content, unless it is already stored.
+    file_path = temp_path(secrets.token_hex(12))
+    content_hash = hashlib.sha256()
+    try:
+        file_size = await write_file(file_path, content_hash, storage_codec)
+    except Exception:
+        await delete_file(file_path)
+        raise
+
+    codec = await store_blob(file_path, content_hash.hexdigest(), file_size, storage_codec)
+    file_db = {"file_name": file_name, "size": file_size/1000.0, "file": None, "sensor_name": sensor_name,
+               "job_name": job_name, "content_hash": content_hash.hexdigest(), "blob": True, "codec": codec}
+    file_db_json = jsonable_encoder(file_db)
+    return await add_data(file_db_json)
+
+
+async def add_duplicate_data(sensor_name: str, job_name: str, file_name: str, content_hash: str) -> dict:
+    # Adds a data entry for content that is already stored, only the metadata is written.
+    # Returns None if there is no blob with this content (or its file got lost), the file has to be uploaded then.
+    blob = await retrieve_blob(content_hash)
+    if not blob:
+        return None
+    # the reference keeps the file from being deleted, so the file is checked after it was added
+    blob = await reference_blob(content_hash, blob["size"], blob["codec"])
+    if not await is_file(blob_path(content_hash, blob["codec"])):
+        if await release_blob(content_hash):
+            await forget_blob(content_hash)
+        return None
+    file_db = {"file_name": file_name, "size": blob["size"]/1000.0, "file": None, "sensor_name": sensor_name,
+               "job_name": job_name, "content_hash": content_hash, "blob": True, "codec": blob["codec"]}
+    file_db_json = jsonable_encoder(file_db)
+    return await add_data(file_db_json)
+
+
+async def store_blob(file_path: str, content_hash: str, size: int, codec: str = None) -> str:
+    # Adds a reference to the blob of content_hash and moves the file at file_path (compressed with codec) to the
+    # blob, if there is no file with this content yet. Otherwise the file is a duplicate and deleted, it takes no
+    # extra space. Returns the codec of the blob, which is the one of the first file stored with this content.
+    blob = await reference_blob(content_hash, size, codec)
+    target = blob_path(content_hash, blob["codec"])
+    if blob["codec"] != codec and not await is_file(target):
+        # the file of the blob got lost, this file replaces it
+        if await replace_blob_codec(content_hash, blob["codec"], codec):
+            blob["codec"] = codec
+            target = blob_path(content_hash, codec)
+    if await is_file(target) or blob["codec"] != codec:
+        await delete_file(file_path)
+        return blob["codec"]
+    await make_dirs(os.path.dirname(target))
+    await move_file(file_path, target)  # atomic, a parallel upload of the same content writes the same bytes
+    return codec
+
+
+async def store_upload_chunk(session: dict, chunk_nr: int, chunk_md5: str, write_chunk):
+    # Verifies and stores a chunk of an upload session and appends all chunks that are in order to the file.
+    # write_chunk(path, file_hash) writes the received chunk to path, updates file_hash and returns the size.
+    # The file is stored once all chunks are assembled. Returns the updated session and the new data entry,
+    # which is None as long as the session is not complete.
+    if session["state"] != "open":
+        return session, await retrieve_data(session["data_id"]) if session["data_id"] else None
+    if chunk_nr not in session["missing_chunks"]:
+        return session, None  # the chunk was sent again, e.g. because the response got lost
+
+    temp_folder = upload_session_folder(session["id"])
+    try:
+        await make_dirs(temp_folder)
     except Exception:
         return ErrorResponseModel(406, f"Could not create: {temp_folder}")
-    filepath = temp_folder + in_file.filename
-    async with aiofiles.open(filepath, 'wb') as f:
-        await f.write(file_content)
+
+    # write the chunk under a unique name first, parallel requests must never see a partly written chunk.
+    # The md5 is computed while the chunk is written, in the storage thread pool, so the event loop keeps serving
+    # requests.
+    chunk_path = temp_folder + "part" + str(chunk_nr)
+    upload_path = chunk_path + "." + secrets.token_hex(8) + ".upload"
+    md5hash = hashlib.md5()
+    try:
+        chunk_size = await write_chunk(upload_path, md5hash)
+    except Exception:
+        await delete_file(upload_path)
+        raise
 
     # verify the chunk is correct
-    md5hash = get_md5_hash(filepath)
-    print(f"MD5({filepath})={md5hash}")
-    if md5hash != chunk_md5:
-        remove_file(filepath)  # cleanup: delete the wrong file
+    print(f"MD5({chunk_path})={md5hash.hexdigest()}")
+    if md5hash.hexdigest() != chunk_md5:
+        await delete_file(upload_path)  # cleanup: delete the wrong file
         return ErrorResponseModel(409, "Wrong checksum.")
-
-    if chunks_remaining > 0:
-        # wait for more chunks
-        # TODO: What happens if the last chunk is never send? You fill the disk with garbage. Implement a auto-delete
-        #  after n seconds. (At this stage all devices are authenticated, so it is not critical.)
-        return ResponseModel(None, "Chunk uploaded.")
-
-    # Last chunk received. (1) combine the chunks, (2) insert file-ref to DB, (3) store on disk, (4) cleanup tmp-storage
-    full_file = bytearray()
-    raw_name = in_file.filename[:in_file.filename.rindex("_part")]
-    for i in range(chunk_nr+1):
-        chunk_name = temp_folder + raw_name + "_part" + str(i)
-        if not os.path.exists(chunk_name):
-            return ErrorResponseModel(416, f"Missing file-part: {raw_name}_part{i}")
-        with open(chunk_name, "rb") as f:
-            chunk_data = f.read()
-            full_file.extend(chunk_data)
-
-    # insert file-ref to DB
-    job = await return_fixed_job_by_job_id(job_id)
+    await move_file(upload_path, chunk_path)
+    updated_session = await add_received_chunk(session["id"], chunk_nr, chunk_size)
+    if not updated_session:
+        return await retrieve_upload_session(session["id"]), None  # a parallel request stored this chunk
+    session = updated_session
+
+    # append all chunks that are now in order to the assembly file, so the last chunk only needs a rename.
+    # The lock keeps parallel chunks of the session from appending at the same time.
+    async with assembly_locks.setdefault(session["id"], asyncio.Lock()):
+        assembled_chunks, file_size, codec = await run_blocking(append_chunks_in_order, temp_folder, storage_codec)
+    if assembled_chunks < session["chunk_count"]:
+        return session, None
+
+    # All chunks assembled. (1) move the assembled file to its blob, (2) insert file-ref to DB,
+    # (3) cleanup tmp-storage
+    job = await return_fixed_job_by_job_id(session["job_id"], with_assignments=False)
+    if not job:
+        return ErrorResponseModel(404, "Fixed job with id {0} doesn't exist".format(session["job_id"]))
+    if not await claim_upload_session(session["id"]):
+        return session, None  # a parallel request is already storing the file
+    assembly_locks.pop(session["id"], None)
     job_name = job["name"]
-    file_db = {"file_name": raw_name, "size": len(full_file) / 1000.0, "file": None,
-               "sensor_name": sensor_name, "job_name": job_name, }
+    content_hash = await run_blocking(assembled_sha256_hash, temp_folder + "assembly", file_size, codec)
+
+    # the rename into the blob folder is atomic and does not copy the data again
+    codec = await store_blob(temp_folder + "assembly", content_hash, file_size, codec)
+    file_db = {"file_name": session["file_name"], "size": file_size / 1000.0, "file": None,
+               "sensor_name": session["sensor_name"], "job_name": job_name, "content_hash": content_hash,
+               "blob": True, "codec": codec}
     file_db_json = jsonable_encoder(file_db)
     new_file_db = await add_data(file_db_json)
     file_id = new_file_db.get('id')
 
-    # save file to filesystem
-    filepath = work_dir + '/app/server/file_uploads/' + raw_name + "_" + file_id
-    async with aiofiles.open(filepath, 'wb') as f:
-        await f.write(full_file)
-
     # cleanup tmp-storage
-    for file in os.listdir(temp_folder):
-        print(f"delete: {file}")
-        remove_file(os.path.join(temp_folder, file))
-    shutil.rmtree(temp_folder)
-
-    return ResponseModel(new_file_db, "Data uploaded successfully.")
-
-
-def remove_file(path: str) -> None:
-    os.unlink(path)
-
-
-def get_md5_hash(file_name: str) -> str:
-    # src: https://stackoverflow.com/questions/16874598/how-to-calculate-the-md5-checksum-of-a-file-in-python
-    # Read 8192 (or 2¹³) bytes of a file at a time instead of all at once with f.read() to use less memory.
-    with open(file_name, "rb") as f:
-        file_hash = hashlib.md5()
-        chunk = f.read(8192)
-        while chunk:
-            file_hash.update(chunk)
-            chunk = f.read(8192)
+    await delete_folder(temp_folder)
+
+    await complete_upload_session(session["id"], file_id)
+    return await retrieve_upload_session(session["id"]), new_file_db
+
+
+def reset_upload_folder():
+    # deletes all stored files and chunks. Blocking, run it in the storage thread pool.
+    remove_folder(upload_folder)
+    os.mkdir(upload_folder)
+    open(upload_folder + ".gitkeep", 'a').close()
+
+
+def copy_and_hash(source, destination_path: str, file_hash, codec: str = None) -> int:
+    # Copies a file object block by block to destination_path and updates file_hash with every block, so the data
+    # is read only once and only one block is held in memory. The copy is compressed with codec on the way.
+    # Blocking, run it in the storage thread pool. Returns the number of bytes copied (before compression).
+    size = 0
+    source.seek(0)
+    with open(destination_path, "wb") as raw_destination, \
+            compressing_writer(raw_destination, codec, settings.storage_compression_level) as destination:
+        block = source.read(COPY_BLOCK_SIZE)
+        while block:
+            destination.write(block)
+            file_hash.update(block)
+            size += len(block)
+            block = source.read(COPY_BLOCK_SIZE)
+    return size
+
+
+async def write_stream_and_hash(stream, destination_path: str, file_hash, codec: str = None) -> int:
+    # Writes an async stream of bytes (e.g. request.stream()) to destination_path, compressed with codec, and updates
+    # file_hash. The pieces of the stream are collected to blocks, which are written and hashed in the storage
+    # thread pool. Returns the number of bytes written (before compression).
+    size = 0
+    block = bytearray()
+    raw_destination = await run_blocking(open, destination_path, "wb")
+    try:
+        destination = await run_blocking(compressing_writer, raw_destination, codec,
+                                              settings.storage_compression_level)
+    except Exception:
+        raw_destination.close()
+        raise
+    try:
+        async for piece in stream:
+            block += piece
+            if len(block) >= COPY_BLOCK_SIZE:
+                await run_blocking(write_and_hash_block, destination, file_hash, block)
+                size += len(block)
+                block = bytearray()
+        if block:
+            await run_blocking(write_and_hash_block, destination, file_hash, block)
+            size += len(block)
+    finally:
+        await run_blocking(destination.close)
+        await run_blocking(raw_destination.close)
+    return size
+
+
+def write_and_hash_block(destination, file_hash, block):
+    destination.write(block)
+    file_hash.update(block)
+
+
+def append_chunks_in_order(temp_folder: str, codec: str = None) -> (int, int, str):
+    # Appends every received chunk 'part<N>' that is next in line to 'assembly' and deletes the chunk-file.
+    # The chunks are copied block by block, so only one block is held in memory regardless of the file size.
+    # Every chunk is compressed with codec as a frame of its own, the frames together form the compressed file.
+    # The progress is stored as '<count> <size> <original size> <codec>' in 'assembled'. An append that was
+    # interrupted before its progress got stored is cut off again, so a chunk is never appended twice.
+    # Returns the number of assembled chunks, the size of the assembled content and the codec of the assembly file,
+    # which is the one its first chunk was appended with.
+    assembly_path = temp_folder + "assembly"
+    progress_path = temp_folder + "assembled"
+    assembled_chunks, assembled_size, content_size = 0, 0, 0
+    if os.path.exists(progress_path):
+        with open(progress_path, "r") as f:
+            progress = f.read().split()
+        assembled_chunks, assembled_size = int(progress[0]), int(progress[1])
+        content_size = int(progress[2]) if len(progress) > 2 else assembled_size
+        codec = progress[3] if len(progress) > 3 and progress[3] != "-" else None
+
+    # the file hash is updated with the appended blocks, unless the hashed size doesn't match (e.g. after a restart)
+    hashed_size, file_hash = assembly_hashes.pop(assembly_path, (0, hashlib.sha256()))
+    if hashed_size != content_size:
+        file_hash = None
+
+    with open(assembly_path, "r+b" if os.path.exists(assembly_path) else "wb") as assembly:
+        assembly.seek(assembled_size)
+        assembly.truncate()
+        chunk_path = temp_folder + "part" + str(assembled_chunks)
+        while os.path.exists(chunk_path):
+            with open(chunk_path, "rb") as chunk, \
+                    compressing_writer(assembly, codec, settings.storage_compression_level) as destination:
+                block = chunk.read(COPY_BLOCK_SIZE)
+                while block:
+                    destination.write(block)
+                    if file_hash is not None:
+                        file_hash.update(block)
+                    content_size += len(block)
+                    block = chunk.read(COPY_BLOCK_SIZE)
+            assembly.flush()
+            assembled_chunks += 1
+            assembled_size = assembly.tell()
+            with open(progress_path + ".tmp", "w") as f:
+                f.write(f"{assembled_chunks} {assembled_size} {content_size} {codec or '-'}")
+            os.replace(progress_path + ".tmp", progress_path)
+            remove_file(chunk_path)
+            chunk_path = temp_folder + "part" + str(assembled_chunks)
+    if file_hash is not None:
+        assembly_hashes[assembly_path] = (content_size, file_hash)
+    return assembled_chunks, content_size, codec
+
+
+def assembled_sha256_hash(assembly_path: str, file_size: int, codec: str = None) -> str:
+    # returns the sha256 of an assembled file, it is only read again if the hash was not kept during the assembly
+    hashed_size, file_hash = assembly_hashes.pop(assembly_path, (None, None))
+    if hashed_size == file_size:
+        return file_hash.hexdigest()
+    with open_stored_file(assembly_path, codec) as f:
+        file_hash = hashlib.sha256()
+        block = f.read(COPY_BLOCK_SIZE)
+        while block:
+            file_hash.update(block)
+            block = f.read(COPY_BLOCK_SIZE)
     return file_hash.hexdigest()
-
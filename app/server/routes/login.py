@@ -1,13 +1,12 @@
 # login functions for login page
 from fastapi import APIRouter, Depends, Request, HTTPException, Security, status, Header, Response
-from fastapi.responses import FileResponse
 from fastapi_another_jwt_auth import AuthJWT
 from app.server.models.login import UserLogin, UserRegister, Settings, ResponseModel, ResponseTokenModel, \
     ErrorResponseModel
 from datetime import timedelta, datetime
-import os
+import io
 import zipfile
-from starlette.background import BackgroundTasks
+from app.server.storage import run_blocking
 
 from app.server.database import (
     add_token_to_blacklist,
@@ -30,19 +29,11 @@ router = APIRouter()
 
 settings = Settings()
 
-work_dir = os.getcwd()  # directory from which the script is executed, "sensor-management-system" is assumed
-
-
 @AuthJWT.load_config
 def get_config():
     return settings
 
 
-def remove_file(path: str) -> None:
-    if os.path.exists(path):
-        os.remove(path)
-
-
 @router.post('/userlogin', response_description="Successfully logged in")
 async def userlogin(credentials: UserLogin, Authorize: AuthJWT = Depends()):
     # credentials in body (is not logged by nginX)
@@ -162,7 +153,7 @@ async def refresh(Authorize: AuthJWT = Depends()):
 
 
 @router.get('/sensor_token/{_sensor_id}')
-async def create_sensor_tokens(_sensor_id: str, background_tasks: BackgroundTasks, _Authorize: AuthJWT = Depends()):
+async def create_sensor_tokens(_sensor_id: str, _Authorize: AuthJWT = Depends()):
     # requires permissions:admin
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["admin"]):
         return ErrorResponseModel(401, "Unauthorized.")
@@ -197,34 +188,17 @@ async def create_sensor_tokens(_sensor_id: str, background_tasks: BackgroundTask
     if not success:
         return ErrorResponseModel(500, "Unable to create refreshToken.")
 
-    # write tokens in files
-    base_path = work_dir + '/app/server/file_uploads/'
-    accToken_filename = sensor_name + "_accesstoken.txt"
-    accToken_filepath = base_path + accToken_filename
-    with open(accToken_filepath, "w+") as accToken_file:
-        accToken_file.write(access_token)
-    refToken_filename = sensor_name + "_refreshtoken.txt"
-    refToken_filepath = base_path + refToken_filename
-    with open(refToken_filepath, "w+") as refToken_file:
-        refToken_file.write(refresh_token)
-    # zip it
+    # zip the tokens, the archive is built in memory in the storage thread pool
     zip_name = sensor_name + "_tokens.zip"
-    zip_filepath = base_path + zip_name
-    zf = zipfile.ZipFile(zip_filepath, "w")
-    zf.write(accToken_filepath, accToken_filename)
-    zf.write(refToken_filepath, refToken_filename)
-    zf.close()
-    # cleanup
-    if os.path.exists(accToken_filepath):
-        os.remove(accToken_filepath)
-    if os.path.exists(refToken_filepath):
-        os.remove(refToken_filepath)
-    background_tasks.add_task(remove_file, zip_filepath)
+    token_files = {sensor_name + "_accesstoken.txt": access_token, sensor_name + "_refreshtoken.txt": refresh_token}
+    try:
+        zip_content = await run_blocking(create_zip, token_files)
+    except Exception:
+        return ErrorResponseModel(500, "Token file can not be written.")
 
     # prepare the response
-    if os.path.isfile(zip_filepath):
-        return FileResponse(zip_filepath, filename=zip_name)
-    return ErrorResponseModel(500, "Token file can not be written.")
+    return Response(zip_content, media_type="application/zip",
+                    headers={"Content-Disposition": 'attachment; filename="{0}"'.format(zip_name)})
 
 
 @router.delete('/logout')
@@ -273,6 +247,34 @@ async def validate_access_token_rights(Authorize: AuthJWT, required_permissions=
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token!.")
 
 
+async def access_token_claims(token: str):
+    # Returns the claims of a valid (incl. not expired and not blacklisted) access token, None otherwise.
+    # For checks outside of a route, where no AuthJWT dependency is available.
+    Authorize = AuthJWT()
+    try:
+        Authorize.jwt_required("websocket", token=token)
+        raw_jwt = Authorize.get_raw_jwt(token)
+        if await check_token_in_blacklist(raw_jwt['jti']):
+            return None
+        return raw_jwt
+    except Exception:
+        return None
+
+
+async def validate_websocket_token_rights(token: str, required_permissions=None) -> bool:
+    # Checks the access token a WebSocket sent with its handshake like validate_access_token_rights does,
+    # returns False instead of raising an HTTPException, the WebSocket has to be closed by the caller
+    if required_permissions is None:
+        required_permissions = [""]
+    raw_jwt = await access_token_claims(token)
+    if raw_jwt is None:
+        return False
+    role = raw_jwt.get('role')
+    if type(role) == list:
+        role = role[0]
+    return role in required_permissions
+
+
 # @router.post('/validate_access_token')
 async def __validate_access_token(Authorize: AuthJWT):
     # returns true if access token valid (incl. not expired) and not blacklisted
@@ -357,3 +359,12 @@ async def verify_tokens_is_admin_or_target_sub(_Authorize: AuthJWT, target_sub:
     if sub == target_sub:
         return True
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Insufficient rights.")
+
+
+def create_zip(files: dict) -> bytes:
+    # returns a zip archive of the files (file name -> text content). Blocking, run it in the storage thread pool.
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        for file_name, content in files.items():
+            zf.writestr(file_name, content)
+    return archive.getvalue()
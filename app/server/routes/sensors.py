@@ -4,11 +4,15 @@
 # The JSON Compatible Encoder from FastAPI converts the models into a format that's
 # JSON compatible
 
-from fastapi import APIRouter, Body, Depends, HTTPException, status
+import asyncio
+
+from fastapi import APIRouter, Body, Depends, HTTPException, Request, Response, status
 from fastapi.encoders import jsonable_encoder
 from fastapi_another_jwt_auth import AuthJWT
 from app.server.routes.login import validate_access_token_rights
-from datetime import timedelta, datetime
+from app.server.routes.FixedJobs import job_stream_allowed
+from datetime import timedelta
+from typing import Optional
 
 
 from app.server.database import (
@@ -20,7 +24,21 @@ from app.server.database import (
     clear_all_sensors,
     add_sensor,
     write_sensor_status,
+    flush_sensor_status,
+    flush_sensor_status_history,
+    retrieve_sensor_status_history,
+    retrieve_sensor_locations,
+    retrieve_sensor_locations_version,
+    retrieve_sensor_location_clusters,
+    retrieve_sensor_summary,
+    rebuild_sensor_locations,
+    mark_offline_sensor_locations,
+    sensor_status_flush_needed,
+    sensor_status_settings,
     return_user_role,
+    set_sensor_status,
+    return_pending_fixed_jobs_by_sensorname,
+    retrieve_job_version,
 )
 from app.server.models.sensors import (
     ErrorResponseModel,
@@ -29,42 +47,99 @@ from app.server.models.sensors import (
     UpdateSensorsModel,
     UpdateAllSensorsModel,
     UpdateSensorStatusModel,
+    SensorSyncModel,
 )
 
 router = APIRouter()
 
-#location-lists for map-page
-online_sensor_locations = [] #[(lat,long)]
-offline_sensor_locations = [] #[(lat,long)]
-    
+MAX_HISTORY_BUCKETS = 10000  # buckets returned by one status history query
+MAX_MAP_ZOOM = 22
+CLUSTER_CELLS_PER_TILE = 4  # the sensors of a map tile (256 pixels) are clustered on a 4x4 grid
+
+
+async def run_sensor_status_flusher():
+    # background task started with the app: writes the buffered sensor status updates every
+    # status_flush_interval_ms, or earlier if status_flush_max_entries sensors are waiting
+    while True:
+        try:
+            await asyncio.wait_for(sensor_status_flush_needed.wait(),
+                                   sensor_status_settings.status_flush_interval_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+        sensor_status_flush_needed.clear()
+        try:
+            await flush_sensor_status()
+        except Exception as ex:
+            print(f"run_sensor_status_flusher: {ex}")
+        try:
+            await flush_sensor_status_history()
+        except Exception as ex:
+            print(f"run_sensor_status_flusher: history: {ex}")
+
+#location-lists for map-page: [online positions, offline positions] of the version in the db, cached per worker.
+#The status updates keep the positions in the db up to date, the version changes whenever the map changes.
+location_snapshot = {"version": None, "locations": None}
+#fleet summary cached per worker for summary_cache_seconds, the lock lets one request compute it at a time
+sensor_summary_cache = {"expires": 0, "summary": None}
+sensor_summary_lock = asyncio.Lock()
+
+
+async def run_sensor_location_refresher():
+    # background task started with the app: marks the sensors offline that stopped sending their status
+    while True:
+        try:
+            await mark_offline_sensor_locations()
+        except Exception as ex:
+            print(f"run_sensor_location_refresher: {ex}")
+        await asyncio.sleep(sensor_status_settings.location_refresh_interval)
+
+
 @router.get("/update_locations", response_description="Sensor location list updated")
 async def update_sensor_list( _Authorize: AuthJWT=Depends()):
-    #function to update the above defined sensor location lists with the current db data
-    global online_sensor_locations,offline_sensor_locations
+    #function to rebuild the sensor locations from the sensor list, they are kept up to date by the status updates
     #permissions: admin
     if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["admin"]):
         return ErrorResponseModel(401, "Unauthorized.")
-
-    online_sensor_locations = [] #reset
-    offline_sensor_locations = [] #reset
-    sensors = await retrieve_all_sensor_lists() #retrieve sensor data from db
-    curr_time = datetime.utcnow() #get current time for online check
-
-    for sensor in sensors:
-        if sensor['status']['location_lat'] is None or sensor['status']['location_lon'] is None: #skip sensor if no location set
-            continue
-        #sensor is considered online if its last contact ("status_time") was less than 24h ago
-        if (curr_time - datetime.utcfromtimestamp(sensor['status']['status_time'])).days == 0:
-            online_sensor_locations.append([round(float(sensor['status']['location_lat']),2),round(float(sensor['status']['location_lon']),2)]) #cut after 2 decimal places!
-        else:
-           offline_sensor_locations.append([round(float(sensor['status']['location_lat']),2),round(float(sensor['status']['location_lon']),2)])
+    await rebuild_sensor_locations()
     return ResponseModel("", "Location list updated.")
 
 @router.get("/get_locations", response_description="Sensor location list retrieved")
-async def get_sensor_list():
-    #function to deliver the sensors' locations to the map-page
-    global online_sensor_locations,offline_sensor_locations
-    return ResponseModel([online_sensor_locations,offline_sensor_locations], "Location lists retrieved successfully")
+async def get_sensor_list(request: Request, response: Response):
+    #function to deliver the sensors' locations to the map-page, clients can revalidate with If-None-Match
+    version = await retrieve_sensor_locations_version()
+    etag = '"' + str(version) + '"'
+    if request.headers.get("if-none-match") in (etag, "W/" + etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    if location_snapshot["version"] != version:
+        locations = await retrieve_sensor_locations()
+        # the map may have changed while it was read, the snapshot keeps the older version then
+        location_snapshot["version"], location_snapshot["locations"] = version, locations
+    response.headers["ETag"] = etag
+    return ResponseModel(location_snapshot["locations"], "Location lists retrieved successfully")
+
+
+@router.get("/locations", response_description="Sensor location clusters retrieved")
+async def get_sensor_location_clusters(request: Request, response: Response, bbox: str, zoom: int):
+    #function to deliver the sensors of the visible part of the map-page, clustered for the zoom level of the map.
+    #bbox: "west,south,east,north" in degrees, zoom: zoom level of the map tiles (0 = whole world on one tile)
+    try:
+        west, south, east, north = [float(value) for value in bbox.split(",")]
+    except ValueError:
+        return ErrorResponseModel(400, "bbox has to be west,south,east,north in degrees.")
+    # the box must not be empty, an area without extent makes an invalid polygon
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and west != east and -90 <= south < north <= 90):
+        return ErrorResponseModel(400, "bbox has to be west,south,east,north in degrees, with south < north "
+                                       "and west != east.")
+    if not 0 <= zoom <= MAX_MAP_ZOOM:
+        return ErrorResponseModel(400, "zoom has to be between 0 and " + str(MAX_MAP_ZOOM) + ".")
+    version = await retrieve_sensor_locations_version()
+    etag = '"' + str(version) + '"'
+    if request.headers.get("if-none-match") in (etag, "W/" + etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    cell_degrees = 360 / (2 ** zoom * CLUSTER_CELLS_PER_TILE)
+    clusters = await retrieve_sensor_location_clusters(west, south, east, north, cell_degrees)
+    response.headers["ETag"] = etag
+    return ResponseModel(clusters, "Sensor location clusters retrieved successfully")
 
 
 @router.put("/update/{_name}", response_description="Sensor status updated.")
@@ -80,6 +155,87 @@ async def update_sensor_status(_name: str, status_update: UpdateSensorStatusMode
     return ErrorResponseModel(500, str(updated_sensor))
 
 
+@router.get("/status_history", response_description="Sensor status history retrieved")
+async def get_sensor_status_history(start_time: int, end_time: int, bucket_seconds: int = 3600,
+                                    sensor_name: Optional[str] = None, _Authorize: AuthJWT=Depends()):
+    # min/avg/max of the heartbeats per time bucket, of one sensor or of all sensors if no sensor_name is given
+    #permissions: user, admin
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+    if bucket_seconds <= 0 or end_time <= start_time:
+        return ErrorResponseModel(400, "bucket_seconds has to be positive and end_time after start_time.")
+    if (end_time - start_time) / bucket_seconds > MAX_HISTORY_BUCKETS:
+        return ErrorResponseModel(400, "Too many buckets, increase bucket_seconds (at most "
+                                  + str(MAX_HISTORY_BUCKETS) + " buckets).")
+    buckets = await retrieve_sensor_status_history(sensor_name, start_time, end_time, bucket_seconds)
+    return ResponseModel(buckets, "Sensor status history retrieved successfully")
+
+
+@router.get("/summary", response_description="Sensor summary retrieved")
+async def get_sensor_summary(_Authorize: AuthJWT=Depends()):
+    # counts of the fleet by online state, last contact, connectivity, OS version and temperature
+    #permissions: user, admin
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["user", "admin"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+    async with sensor_summary_lock:
+        loop_time = asyncio.get_running_loop().time()
+        if sensor_summary_cache["expires"] <= loop_time:
+            sensor_summary_cache["summary"] = await retrieve_sensor_summary()
+            sensor_summary_cache["expires"] = loop_time + sensor_status_settings.summary_cache_seconds
+    return ResponseModel(sensor_summary_cache["summary"], "Sensor summary retrieved successfully")
+
+
+async def apply_job_states(sensor_name: str, job_id: str, states: list) -> list:
+    # applies the state changes of one job in the order they were sent, returns the result of each one
+    results = []
+    for state in states:
+        if not state.startswith(("running", "finished", "failed")):
+            results.append("invalid status")
+            continue
+        updated_fixed_job = await set_sensor_status(job_id, sensor_name, state)
+        if updated_fixed_job in ("Not found", "Not included"):
+            results.append(updated_fixed_job)
+        else:
+            results.append("updated" if updated_fixed_job else "failed")
+    return results
+
+
+@router.post("/{_name}/sync", response_description="Sensor synchronized")
+async def sync_sensor(_name: str, sync: SensorSyncModel = Body(...), _Authorize: AuthJWT=Depends()):
+    # one request for a whole sensor cycle: status update, state changes of its jobs and its pending jobs.
+    # The status update and the state changes of different jobs run concurrently, the pending jobs are read after
+    # them and are only sent if their version differs from jobs_version.
+    #permissions: admin, sensor (a sensor only synchronizes itself)
+    if not await validate_access_token_rights(Authorize=_Authorize, required_permissions=["admin", "sensor"]):
+        return ErrorResponseModel(401, "Unauthorized.")
+    if not job_stream_allowed(None, _name, _Authorize):
+        return ErrorResponseModel(403, "Insufficient rights.")
+
+    states_by_job = {}
+    for job_state in sync.job_states:
+        states_by_job.setdefault(job_state.job_id, []).append(job_state.status)
+    work = [apply_job_states(_name, job_id, states) for job_id, states in states_by_job.items()]
+    if sync.status is not None:
+        work.append(write_sensor_status(_name, jsonable_encoder(sync.status)))
+    results = await asyncio.gather(*work)
+
+    job_results = dict(zip(states_by_job.keys(), results))
+    job_states = []
+    for job_state in sync.job_states:
+        job_states.append({"job_id": job_state.job_id, "status": job_state.status,
+                           "result": job_results[job_state.job_id].pop(0)})
+    status_result = None
+    if sync.status is not None:
+        status_result = "updated" if results[-1] == _name else results[-1]
+
+    version = retrieve_job_version(_name)
+    fixed_jobs = None
+    if version is None or version != sync.jobs_version:
+        fixed_jobs = await return_pending_fixed_jobs_by_sensorname(_name)
+    return ResponseModel({"status": status_result, "job_states": job_states, "jobs_version": version,
+                          "jobs": fixed_jobs}, "Sensor synchronized")
+
+
 @router.get("/", response_description="Sensor lists retrieved")
 async def get_all_sensor_lists( _Authorize: AuthJWT=Depends()):
     #permissions: admin, user
@@ -0,0 +1,180 @@
+# This file knows where the uploaded files are stored in app/server/file_uploads/:
+# - blobs/<aa>/<bb>/<sha256>[.gz|.zst]: content-addressed files, one file per distinct content shared by all data
+#   entries with this content. The two levels of subfolders (first and second byte of the hash) keep every folder
+#   small. Files can be compressed with a codec, the suffix tells which one.
+# - <file_name>_<id>: files that were uploaded before the content-addressed storage was introduced,
+#   `python -m app.server.migrate_storage` moves them to the blobs
+# - tmp_<...>: chunks of running upload sessions and files that are still being received
+#
+# Blocking file system calls must not run on the event loop, a slow disk would stall every request. The async
+# functions below run them in a thread pool of their own, its size bounds the threads waiting for the disk.
+
+import asyncio
+import gzip
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import aiofiles
+
+from app.server.models.data import StorageSettings
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for the "zstd" codec
+    zstandard = None
+
+work_dir = os.getcwd()  # directory from which the script is executed, "sensor-management-system" is assumed
+upload_folder = work_dir + '/app/server/file_uploads/'
+blob_folder = upload_folder + 'blobs/'
+READ_BLOCK_SIZE = 1024 * 1024  # bytes read from a stored file at once
+storage_executor = ThreadPoolExecutor(max_workers=StorageSettings().storage_io_threads, thread_name_prefix="storage")
+# codec -> suffix of the compressed files. The codec names are the HTTP content-codings of the formats.
+CODEC_SUFFIXES = {None: '', "gzip": '.gz', "zstd": '.zst'}
+
+
+def blob_path(content_hash: str, codec: str = None) -> str:
+    return blob_folder + content_hash[0:2] + '/' + content_hash[2:4] + '/' + content_hash + CODEC_SUFFIXES[codec]
+
+
+def legacy_data_path(file_name: str, data_id: str) -> str:
+    return upload_folder + file_name + "_" + data_id
+
+
+def data_file_path(data: dict) -> str:
+    # path of the file of a data entry (as returned by data_helper)
+    if data["blob"]:
+        return blob_path(data["content_hash"], data["codec"])
+    return legacy_data_path(data["file_name"], data["id"])
+
+
+def temp_path(name: str) -> str:
+    return upload_folder + 'tmp_' + name
+
+
+async def run_blocking(func, *args, **kwargs):
+    # runs a blocking function in the storage thread pool and returns its result
+    return await asyncio.get_running_loop().run_in_executor(storage_executor, partial(func, *args, **kwargs))
+
+
+def remove_file(path: str) -> None:
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def remove_folder(path: str) -> None:
+    shutil.rmtree(path, ignore_errors=True)
+
+
+async def delete_file(path: str):
+    await run_blocking(remove_file, path)
+
+
+async def delete_folder(path: str):
+    await run_blocking(remove_folder, path)
+
+
+async def file_exists(path: str) -> bool:
+    return await run_blocking(os.path.exists, path)
+
+
+async def is_file(path: str) -> bool:
+    return await run_blocking(os.path.isfile, path)
+
+
+async def file_stat(path: str) -> os.stat_result:
+    return await run_blocking(os.stat, path)
+
+
+async def make_dirs(path: str):
+    await run_blocking(os.makedirs, path, exist_ok=True)
+
+
+async def move_file(source: str, destination: str):
+    # atomic on the same file system, an existing destination is replaced
+    await run_blocking(os.replace, source, destination)
+
+
+def _list_folder(path: str) -> list:
+    with os.scandir(path) as entries:
+        return [(entry.name, entry.path, entry.is_dir(), entry.stat().st_mtime) for entry in entries]
+
+
+async def list_folder(path: str) -> list:
+    # returns (name, path, is a folder, modification time) of every entry of a folder
+    return await run_blocking(_list_folder, path)
+
+
+def codec_available(codec: str) -> bool:
+    if codec == "zstd":
+        return zstandard is not None
+    return codec in CODEC_SUFFIXES
+
+
+class _UncompressedWriter:
+    def __init__(self, raw_file):
+        self.write = raw_file.write
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compressing_writer(raw_file, codec: str = None, level: int = 0):
+    # Returns a file object that compresses what is written to it into raw_file (opened for binary writing).
+    # Closing it ends the compressed frame but leaves raw_file open, so several frames can follow each other in
+    # one file. Blocking, use it in the thread pool.
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level or 3).stream_writer(raw_file, closefd=False)
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=raw_file, mode="wb", compresslevel=level or 6)
+    return _UncompressedWriter(raw_file)
+
+
+def open_stored_file(path: str, codec: str = None):
+    # Opens a stored file for reading its original content. Compressed files may consist of several frames.
+    # Seeking forward is supported, in compressed files it reads and drops the data. Blocking, use it in the
+    # thread pool.
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+async def read_stored_file(path: str, codec: str = None, start: int = 0, end: int = None):
+    # yields the original content of a stored file from byte start to byte end (inclusive, default: the last byte)
+    # block by block
+    remaining = end - start + 1 if end is not None else None
+    if codec is None:
+        async with aiofiles.open(path, "rb", executor=storage_executor) as in_file:
+            await in_file.seek(start)
+            while remaining is None or remaining > 0:
+                block = await in_file.read(READ_BLOCK_SIZE if remaining is None else min(READ_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                if remaining is not None:
+                    remaining -= len(block)
+                yield block
+        return
+
+    in_file = await run_blocking(open_stored_file, path, codec)
+    try:
+        if start:
+            await run_blocking(in_file.seek, start)
+        while remaining is None or remaining > 0:
+            block = await run_blocking(in_file.read,
+                                            READ_BLOCK_SIZE if remaining is None else min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+    finally:
+        await run_blocking(in_file.close)
@@ -0,0 +1,47 @@
+# This file creates ZIP archives as a stream of bytes, so archives of any size can be sent without a temp file.
+# The entries are stored uncompressed, which keeps generating the archive cheap, and always use ZIP64 records,
+# so neither the number of files nor their size is limited. Since the output is not seekable, zipfile writes the
+# sizes and checksums in a data descriptor behind each entry instead of going back to the local header.
+
+from datetime import datetime
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+
+from app.server.storage import read_stored_file
+
+ZIP_MIN_TIMESTAMP = 315532800  # 1980-01-01, ZIP can't store older modification times
+
+
+class _ZipOutput:
+    # file-like sink for ZipFile: collects the written bytes until the generator hands them out.
+    # It has no tell() and no seek(), which tells ZipFile to write a streamable archive.
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+async def stream_zip(entries):
+    # entries: async iterable of (name inside the archive, path on disk, modification timestamp, codec of the file)
+    # yields the archive piece by piece, ready to be used as content of a StreamingResponse.
+    # Compressed files are decompressed, the archive holds the original files.
+    output = _ZipOutput()
+    with ZipFile(output, mode="w", compression=ZIP_STORED, allowZip64=True) as archive:
+        async for arcname, filepath, mtime, codec in entries:
+            info = ZipInfo(arcname, date_time=datetime.fromtimestamp(max(mtime, ZIP_MIN_TIMESTAMP)).timetuple()[:6])
+            info.compress_type = ZIP_STORED
+            with archive.open(info, mode="w", force_zip64=True) as member:
+                async for block in read_stored_file(filepath, codec):  # one block in memory at a time
+                    member.write(block)
+                    yield output.take()
+            yield output.take()  # data descriptor of the entry
+    yield output.take()  # central directory
@@ -1,6 +1,7 @@
 /*jshint esversion: 6*/
 
 var sensorData = [];
+var page_size = 20;
 var host = window.location.protocol + "//" + window.location.host;
 
 document.getElementById("delete_all").onclick = deleteAll;
@@ -9,22 +10,27 @@ document.getElementById("download_all").onclick = downloadAll;
 
 window.onload = startCall();
 
-function startCall() {
+function startCall(cursor=null) {
+  //loads the newest entries page by page, cursor points to the next page
+  var url = host + "/data/?newest_first=true&limit=" + page_size + "&fields=file_name,size,sensor_name,job_name";
+  if (cursor) {
+    url += "&cursor=" + encodeURIComponent(cursor);
+  }
   $.ajax({
     dataTypr: 'array',
     method: 'GET',
-    url: host + "/data/",
+    url: url,
 
     success: function(response) {
-      sensorData = response.data;
-      console.log(sensorData);
-      buildTable(sensorData);
+      sensorData = sensorData.concat(response.data.items);
+      console.log(response.data);
+      buildTable(response.data.items, response.data.next_cursor);
     },
     error: function(response){
       var status = response.status;
       if (status == 401) {
         console.log("401: Unauthorized")
-        perform_JWT_refresh().done(startCall);
+        perform_JWT_refresh().done(function() {startCall(cursor);});
       } else if (status == 403) {
         //redirect to login page
         alert("Insufficient rights.");
@@ -37,18 +43,9 @@ function startCall() {
 }
 
 
-function buildTable(data,showAll=false) {
-  var table = document.getElementById('table_content');
-  var default_number_of_items = 20;
-  //only show newest 20 items if !showAll and we have more items
-  if (showAll || default_number_of_items > data.length){
-    var lastIndex = 0;
-  }else{
-    var lastIndex = data.length - default_number_of_items;
-  }
-
-
-  for (var i = data.length-1; i >=lastIndex; i--) {
+function buildTable(data, next_cursor=null) {
+  //appends the rows of a page, the entries are ordered newest first
+  for (var i = 0; i < data.length; i++) {
     var entry = data[i];
     var row = `
       <tr id="row-${entry.id}">
@@ -68,14 +65,13 @@ function buildTable(data,showAll=false) {
     $(`#download-${entry.id}`).on('click', downloadEntry);
     document.getElementById("download-"+entry.id).setAttribute("href",host + "/data/download/" + entry.id);
   }
-  if (!showAll && data.length > default_number_of_items){
-    /*if not all elements are loaded, show "show all" button */
-    var show_more_button = '<button class="small_buttons" type="button" id="show_all_button" style="left: 50%;margin: 5px auto;text-align:center;display:block;">Show all entries</button>';
+  $('#show_more_button').remove();
+  if (next_cursor){
+    /*if there are older entries, show "show more" button that loads the next page */
+    var show_more_button = '<button class="small_buttons" type="button" id="show_more_button" style="left: 50%;margin: 5px auto;text-align:center;display:block;">Show more entries</button>';
     $('#table').after(show_more_button);
-    $(`#show_all_button`).on('click', function(){
-      document.getElementById('table_content').innerHTML = ''; /*clear table*/
-      document.getElementById('show_all_button').remove();
-      buildTable(data,true); /*rebuilt table with all elements*/
+    $(`#show_more_button`).on('click', function(){
+      startCall(next_cursor);
     });
 
   }
@@ -0,0 +1,405 @@
+# Load benchmark of the upload routes: uploads files with add_sensor_data (POST /data/{sensor_name}/{job_name})
+# and upload_sensor_data_chunk (POST /data/upload/{sensor_name}/{job_id}) with a configurable file size, chunk
+# size and concurrency, and writes a JSON report with the throughput, the p50/p99 latency and the peak memory of
+# the server process.
+#
+# Run it from the root directory with a local mongod running (the app connects to mongodb://localhost:27017):
+#   (env)$ `python tests/upload_benchmark/upload_benchmark.py --file-size 16M --chunk-size 4M --concurrency 8`
+# The app is started with uvicorn on a free port, unless --base-url points to a running server (its memory is
+# only measured if --server-pid is given). The started server is used with a temporary admin user with a random
+# password, which is deleted afterwards like the uploaded files and the benchmark job. A running server is used with
+# the admin given by --username and --password (or BENCHMARK_USERNAME and BENCHMARK_PASSWORD).
+#
+# With --baseline, the report is compared to an earlier report and the exit code is 1 if the throughput dropped
+# or the latency or memory grew by more than --tolerance.
+
+import argparse
+import asyncio
+import hashlib
+import http.client
+import json
+import math
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlencode
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+SENSOR_NAME = "benchmark_sensor"
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+MEMORY_SAMPLE_INTERVAL = 0.05  # seconds between two samples of the server memory
+MAX_RETRIES = 100  # uploads rejected with 429 are sent again after Retry-After, at most this often
+
+
+def parse_size(size: str) -> int:
+    unit = size[-1:].upper()
+    if unit in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[unit])
+    return int(size)
+
+
+def percentile(values: list, percent: float):
+    # nearest-rank percentile, None for no values
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class MemorySampler:
+    # samples the resident memory of a process (Linux /proc) in a thread, peak is the highest sample in bytes
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _rss(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self._rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+            self._stop.wait(MEMORY_SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        if self.pid:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self.pid:
+            self._thread.join()
+
+
+class Client:
+    # minimal HTTP client (standard library only), one connection per thread
+    def __init__(self, base_url: str):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or (443 if url.scheme == "https" else 80)
+        self.https = url.scheme == "https"
+        self.prefix = url.path.rstrip("/")
+        self.cookie = ""
+        self._local = threading.local()
+
+    def _connection(self):
+        if not hasattr(self._local, "connection"):
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self._local.connection = connection_class(self.host, self.port, timeout=600)
+        return self._local.connection
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None):
+        # returns status, headers and body of the response
+        headers = dict(headers or {})
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        connection = self._connection()
+        try:
+            connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            del self._local.connection
+            raise
+
+    def login(self, username: str, password: str):
+        status, headers, body = self.request("POST", "/login/userlogin",
+                                             json.dumps({"username": username, "password": password}).encode(),
+                                             {"Content-Type": "application/json"})
+        if status != 200:
+            raise RuntimeError(f"login failed: {status} {body[:200]!r}")
+        cookies = [cookie.split(";")[0] for cookie in headers.get_all("Set-Cookie", [])]
+        self.cookie = "; ".join(cookie for cookie in cookies if cookie.startswith("access_token_cookie="))
+
+
+def multipart_body(file_name: str, content: bytes) -> (bytes, str):
+    boundary = secrets.token_hex(16)
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"in_file\"; filename=\"{file_name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, "multipart/form-data; boundary=" + boundary
+
+
+class Scenario(ABC):
+    # runs uploads in parallel threads and collects their latencies
+    def __init__(self, name: str, client: Client, args):
+        self.name = name
+        self.client = client
+        self.args = args
+        self.request_latencies = []
+        self.upload_latencies = []
+        self.rejected = 0
+        self.errors = []
+        self.data_ids = []
+        self._lock = threading.Lock()
+
+    def post(self, path: str, body: bytes, content_type: str) -> dict:
+        # sends an upload request, again after Retry-After while it is rejected with 429
+        for _ in range(MAX_RETRIES):
+            start = time.perf_counter()
+            status, headers, response = self.client.request("POST", path, body, {"Content-Type": content_type})
+            if status == 429:
+                with self._lock:
+                    self.rejected += 1
+                time.sleep(float(headers.get("Retry-After", 1)))
+                continue
+            with self._lock:
+                self.request_latencies.append(time.perf_counter() - start)
+            if status != 200:
+                raise RuntimeError(f"{path}: {status} {response[:200]!r}")
+            return json.loads(response)
+        raise RuntimeError(f"{path}: rejected {MAX_RETRIES} times")
+
+    def file_content(self, nr: int) -> bytes:
+        # every file is unique, the content-addressed storage would skip duplicates
+        return secrets.token_bytes(16) + self.base_content[16:]
+
+    @abstractmethod
+    def upload(self, nr: int):
+        # uploads file nr and returns the id of its data entry
+        pass
+
+    def _timed_upload(self, nr: int):
+        start = time.perf_counter()
+        try:
+            data_id = self.upload(nr)
+        except Exception as ex:
+            with self._lock:
+                self.errors.append(str(ex))
+            return
+        with self._lock:
+            self.upload_latencies.append(time.perf_counter() - start)
+            self.data_ids.append(data_id)
+
+    def run(self, server_pid: int) -> dict:
+        self.base_content = os.urandom(self.args.file_size)
+        with MemorySampler(server_pid) as memory:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+                list(pool.map(self._timed_upload, range(self.args.files)))
+            duration = time.perf_counter() - start
+        uploaded_bytes = len(self.upload_latencies) * self.args.file_size
+        return {
+            "scenario": self.name,
+            "uploads": len(self.upload_latencies),
+            "requests": len(self.request_latencies),
+            "errors": len(self.errors),
+            "first_errors": self.errors[:5],
+            "rejected_429": self.rejected,
+            "duration_s": round(duration, 3),
+            "throughput_mib_s": round(uploaded_bytes / duration / SIZE_UNITS["M"], 3) if duration else None,
+            "uploads_per_s": round(len(self.upload_latencies) / duration, 3) if duration else None,
+            "request_latency_p50_s": percentile(self.request_latencies, 50),
+            "request_latency_p99_s": percentile(self.request_latencies, 99),
+            "upload_latency_p50_s": percentile(self.upload_latencies, 50),
+            "upload_latency_p99_s": percentile(self.upload_latencies, 99),
+            "server_peak_rss_bytes": memory.peak,
+        }
+
+
+class SingleUploadScenario(Scenario):
+    # add_sensor_data: the whole file in one multipart request
+    def upload(self, nr: int) -> str:
+        body, content_type = multipart_body(f"benchmark_{nr}.bin", self.file_content(nr))
+        return self.post(f"/data/{SENSOR_NAME}/{self.args.job_name}", body, content_type)["data"]["id"]
+
+
+class ChunkedUploadScenario(Scenario):
+    # upload_sensor_data_chunk: the file in chunks of chunk_size, sent one after the other
+    def upload(self, nr: int) -> str:
+        content = self.file_content(nr)
+        chunk_size = self.args.chunk_size
+        chunk_count = max(1, -(-len(content) // chunk_size))
+        response = None
+        for chunk_nr in range(chunk_count):
+            chunk = content[chunk_nr * chunk_size:(chunk_nr + 1) * chunk_size]
+            query = urlencode({"chunk_nr": chunk_nr, "chunks_remaining": chunk_count - chunk_nr - 1,
+                               "chunk_md5": hashlib.md5(chunk).hexdigest()})
+            body, content_type = multipart_body(f"benchmark_{nr}.bin_part{chunk_nr}", chunk)
+            response = self.post(f"/data/upload/{SENSOR_NAME}/{self.args.job_id}?{query}", body, content_type)
+        return response["data"]["id"]
+
+
+SCENARIOS = {"single": SingleUploadScenario, "chunked": ChunkedUploadScenario}
+
+
+def start_server(port: int, log_path: str) -> subprocess.Popen:
+    log_file = open(log_path, "w")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.server.app:app", "--host", "127.0.0.1",
+                               "--port", str(port), "--log-level", "warning"],
+                              cwd=ROOT_DIR, stdout=log_file, stderr=subprocess.STDOUT)
+    client = Client(f"http://127.0.0.1:{port}")
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with {server.returncode}, see {log_path}")
+        try:
+            client.request("GET", "/data/storage_usage")
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"server did not start within 30s, see {log_path}")
+
+
+class BenchmarkUser:
+    # temporary admin user with a random password in the database the app uses, deleted by remove()
+    EMAIL = "benchmark@localhost"
+
+    def __init__(self):
+        sys.path.insert(0, ROOT_DIR)
+        self.username = "benchmark_" + secrets.token_hex(8)
+        self.password = secrets.token_urlsafe(32)
+        self.loop = asyncio.new_event_loop()  # the database client is bound to the loop of its first operation
+        from app.server.database import add_user
+        added, message = self.loop.run_until_complete(add_user(self.EMAIL, self.username, self.password, "admin"))
+        if not added:
+            self.loop.close()
+            raise RuntimeError(f"adding the benchmark user failed: {message}")
+
+    def remove(self):
+        from app.server.database import delete_user_db
+        try:
+            self.loop.run_until_complete(delete_user_db(self.EMAIL, self.username))
+        finally:
+            self.loop.close()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    # returns the regressions of report compared to baseline
+    regressions = []
+    baseline_scenarios = {scenario["scenario"]: scenario for scenario in baseline["scenarios"]}
+    for scenario in report["scenarios"]:
+        old = baseline_scenarios.get(scenario["scenario"])
+        if not old:
+            continue
+        checks = [("throughput_mib_s", -1), ("request_latency_p50_s", 1), ("request_latency_p99_s", 1),
+                  ("upload_latency_p50_s", 1), ("upload_latency_p99_s", 1), ("server_peak_rss_bytes", 1)]
+        for key, direction in checks:
+            if scenario.get(key) is None or not old.get(key):
+                continue
+            change = (scenario[key] - old[key]) / old[key]
+            if change * direction > tolerance:
+                regressions.append(f"{scenario['scenario']}.{key}: {old[key]} -> {scenario[key]} ({change:+.0%})")
+        if scenario["errors"] > old["errors"]:
+            regressions.append(f"{scenario['scenario']}.errors: {old['errors']} -> {scenario['errors']}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load benchmark of the upload routes, writes a JSON report.")
+    parser.add_argument("--base-url", help="URL of a running server, default: start one")
+    parser.add_argument("--server-pid", type=int, help="pid of the running server, to measure its memory")
+    parser.add_argument("--scenario", choices=["single", "chunked", "all"], default="all")
+    parser.add_argument("--file-size", type=parse_size, default="8M", help="bytes per file, e.g. 512K, 16M, 1G")
+    parser.add_argument("--chunk-size", type=parse_size, default="2M", help="bytes per chunk of chunked uploads")
+    parser.add_argument("--concurrency", type=int, default=4, help="uploads running at the same time")
+    parser.add_argument("--files", type=int, default=32, help="files uploaded per scenario")
+    parser.add_argument("--username", default=os.environ.get("BENCHMARK_USERNAME"),
+                        help="admin of the server given by --base-url, default: $BENCHMARK_USERNAME")
+    parser.add_argument("--password", default=os.environ.get("BENCHMARK_PASSWORD"),
+                        help="password of --username, default: $BENCHMARK_PASSWORD")
+    parser.add_argument("--output", help="file to write the JSON report to, default: stdout")
+    parser.add_argument("--baseline", help="JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change, default 0.2")
+    args = parser.parse_args()
+    if args.base_url and not (args.username and args.password):
+        parser.error("--base-url needs the credentials of an admin: --username and --password "
+                     "or BENCHMARK_USERNAME and BENCHMARK_PASSWORD")
+
+    server = None
+    user = None
+    server_pid = args.server_pid
+    base_url = args.base_url
+    if not base_url:
+        port = free_port()
+        server = start_server(port, os.path.join(os.path.dirname(__file__), "server.log"))
+        server_pid = server.pid
+        base_url = f"http://127.0.0.1:{port}"
+
+    try:
+        if server:
+            user = BenchmarkUser()
+            args.username, args.password = user.username, user.password
+        client = Client(base_url)
+        client.login(args.username, args.password)
+        args.job_name = "benchmark_" + secrets.token_hex(4)
+        start_time = int(time.time()) + 24 * 60 * 60  # a job has to start in the future, it's never run
+        status, _, body = client.request("POST", "/fixedjobs/", json.dumps({
+            "name": args.job_name, "start_time": start_time, "end_time": start_time + 60, "command": "benchmark",
+            "arguments": {},
+            "sensors": [SENSOR_NAME], "states": {}}).encode(), {"Content-Type": "application/json"})
+        if status != 200:
+            raise RuntimeError(f"creating the benchmark job failed: {status} {body[:200]!r}")
+        args.job_id = json.loads(body)["data"]["id"]
+
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": git_commit(),
+            "parameters": {"file_size": args.file_size, "chunk_size": args.chunk_size,
+                           "concurrency": args.concurrency, "files": args.files},
+            "scenarios": [],
+        }
+        names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+        for name in names:
+            client.login(args.username, args.password)  # the access token of a user is only valid for minutes
+            scenario = SCENARIOS[name](name, client, args)
+            report["scenarios"].append(scenario.run(server_pid))
+            for data_id in scenario.data_ids:
+                client.request("DELETE", f"/data/{data_id}")
+        client.request("DELETE", "/fixedjobs/?" + urlencode({"name": args.job_name}))
+    finally:
+        if user:
+            user.remove()
+        if server:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression: " + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())